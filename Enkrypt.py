@@ -1,13 +1,76 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib import import_module
 from typing import BinaryIO
 
 from Crypto.Random import get_random_bytes
 from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import scrypt
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF, scrypt
 import os
 import io
+import stat
+import struct
+import threading
+import time
+import zlib
 
 # see https://nitratine.net/blog/post/python-gcm-encryption-tutorial/
-from s3_wrapper import S3Utils
+from s3_wrapper import S3Utils, add_client_hook
+from instrumentation import instrument_boto_client, span, span_iter
+
+KEY_CACHE_SIZE = 64  # number of derived keys kept in memory
+DATA_KEY_CACHE_SIZE = 1024  # unwrapped per-object data keys of envelope files kept in memory
+
+add_client_hook(instrument_boto_client)  # S3 calls are timed next to the crypto stages
+
+
+class KeyCache:
+    # Bounded LRU of derived keys. Misses are computed under a separate lock so that
+    # concurrent misses don't each run scrypt (128 MB apiece at N=2**17).
+    def __init__(self, maxsize=KEY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+
+    def _lookup(self, cache_key):
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None:
+                self._keys.move_to_end(cache_key)
+            return key
+
+    def get_or_create(self, cache_key, create):
+        key = self._lookup(cache_key)
+        if key is not None:
+            return key
+        with self._create_lock:
+            key = self._lookup(cache_key)
+            if key is None:
+                key = create()
+                with self._lock:
+                    self._keys[cache_key] = key
+                    while len(self._keys) > self.maxsize:
+                        self._keys.popitem(last=False)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+
+key_cache = KeyCache()
+
+
+def derive_key(password, salt, key_len=32, N=2 ** 17, r=8, p=1):
+    def create():
+        with span('kdf.scrypt', N=N):
+            return scrypt(password, salt, key_len=key_len, N=N, r=r, p=p)
+    return key_cache.get_or_create((password, salt, key_len, N, r, p), create)
 
 
 class EncryptorBase:
@@ -16,31 +79,57 @@ class EncryptorBase:
     SALT_LENGTH = 32
     NONCE_LENGTH = 16
     TAG_LENGTH = 16
-    salt = get_random_bytes(SALT_LENGTH)
-    key = scrypt(password, salt, key_len=32, N=2 ** 17, r=8, p=1)
+    KEY_LENGTH = 32
+    KDF_N = 2 ** 17
+    KDF_R = 8
+    KDF_P = 1
     file_in = None
     file_out = None
 
-    def __init__(self, input_filename='', output_filename='', input_string=''):
-        self.cipher = AES.new(self.key, AES.MODE_GCM)
+    def __init__(self, input_filename='', output_filename='', input_string='', input_stream=None):
+        self.cipher = None
         self.output_filename = output_filename
         self.input_filename = input_filename
-        if input_filename or output_filename:
-            self.outputfilestream = open(self.output_filename, 'wb')
+        if input_stream is not None:
+            self.inputfilestream = input_stream
+        elif input_filename:
             self.inputfilestream = open(self.input_filename, 'rb')
         else:
-            self.outputfilestream = io.BytesIO()
             self.inputfilestream = io.BytesIO()
             try:
                 self.inputfilestream.write(input_string.encode('utf-8'))
             except AttributeError:
                 self.inputfilestream.write(input_string)
             self.inputfilestream.seek(0)
+        if output_filename:
+            self.outputfilestream = open(self.output_filename, 'wb')
+        else:
+            self.outputfilestream = io.BytesIO()
+
+    @classmethod
+    def get_key(cls, salt):
+        return derive_key(cls.password, salt, key_len=cls.KEY_LENGTH, N=cls.KDF_N, r=cls.KDF_R, p=cls.KDF_P)
+
+    @classmethod
+    def get_master_key(cls, salt):
+        # key-encryption key of envelope files: scrypt once per salt, then HKDF so it is never
+        # the same key that seals data directly
+        derived = cls.get_key(salt)
+        return key_cache.get_or_create(
+            ('kek', derived), lambda: HKDF(derived, cls.KEY_LENGTH, b'', SHA256, context=b'enkrypt envelope kek'))
+
+    @classmethod
+    def get_segment_key(cls, header):
+        # the key sealing a segmented file: derived from the password, or for envelope files
+        # the object's own data key, unwrapped with the master key
+        if header.wrapped_key is None:
+            return cls.get_key(header.salt)
+        return unwrap_data_key(cls.get_master_key(header.salt), header.wrapped_key)
 
     def read_file_in(self, file_in):
         self.salt = file_in.read(self.SALT_LENGTH)  # The salt we generated was 32 bits long
         nonce = file_in.read(self.NONCE_LENGTH)
-        self.cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        self.cipher = AES.new(self.get_key(self.salt), AES.MODE_GCM, nonce=nonce)
 
     def return_encryption(self, file_out):
         try:
@@ -49,19 +138,45 @@ class EncryptorBase:
             pass
 
 
+_salt_lock = threading.Lock()
+
+
 class Encryptor(EncryptorBase):
-    def __init__(self, *args, **kwargs):
+    _process_salt = None  # generated on first use and shared by writes in this process, so they share one key
+
+    def __init__(self, *args, salt=None, **kwargs):
         super(Encryptor, self).__init__(*args, **kwargs)
+        self.salt = salt or self.get_process_salt()
+        self.cipher = AES.new(self.get_key(self.salt), AES.MODE_GCM)
         self.nonce = self.cipher.nonce
 
+    @classmethod
+    def get_process_salt(cls):
+        with _salt_lock:
+            if Encryptor._process_salt is None:
+                Encryptor._process_salt = get_random_bytes(cls.SALT_LENGTH)
+            return Encryptor._process_salt
+
     def write_header(self, file_out):
         file_out.write(self.salt)
         file_out.write(self.nonce)
 
-    def write_body(self, file_in, file_out):
+    def iter_body(self, file_in):
         while len(data := file_in.read(self.BUFFER_SIZE)):
-            encrypted_data = self.cipher.encrypt(data)
-            file_out.write(encrypted_data)
+            yield self.cipher.encrypt(data)
+
+    def write_body(self, file_in, file_out):
+        if not hasattr(file_in, 'readinto'):
+            for encrypted_data in self.iter_body(file_in):
+                file_out.write(encrypted_data)
+            return
+        # read into and encrypt out of two reused buffers instead of allocating per chunk
+        input_size = stream_size(file_in)
+        buffer_size = min(self.BUFFER_SIZE, input_size) if input_size else self.BUFFER_SIZE
+        buffer, output = memoryview(bytearray(buffer_size)), memoryview(bytearray(buffer_size))
+        while size := file_in.readinto(buffer):
+            self.cipher.encrypt(buffer[:size], output=output[:size])
+            file_out.write(output[:size])
 
     def write_footer(self, file_out):
         tag = self.cipher.digest()
@@ -71,21 +186,47 @@ class Encryptor(EncryptorBase):
     def do_encryption(self):
         with self.outputfilestream as file_out, \
                 self.inputfilestream as file_in:
-            self.write_header(file_out)
-            self.write_body(file_in, file_out)
-            self.write_footer(file_out)
+            with span('encrypt.header'):
+                self.write_header(file_out)
+            with span('encrypt.body') as body:
+                start = file_out.tell()
+                self.write_body(file_in, file_out)
+                body.nbytes = file_out.tell() - start
+            with span('encrypt.footer'):
+                self.write_footer(file_out)
             return self.return_encryption(file_out)
 
+    def iter_encryption(self):
+        # same bytes as do_encryption, yielded as they are produced instead of written out
+        with self.inputfilestream as file_in:
+            header = io.BytesIO()
+            with span('encrypt.header'):
+                self.write_header(header)
+            yield header.getvalue()
+            yield from span_iter('encrypt.body', self.iter_body(file_in))
+            footer = io.BytesIO()
+            with span('encrypt.footer'):
+                self.write_footer(footer)
+            if footer.tell():
+                yield footer.getvalue()
+
 
 class Dcryptor(EncryptorBase):
+    # reads both the single-stream format written by Encryptor and the segmented
+    # format written by SegmentedEncryptor, telling them apart by the magic prefix
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, workers=None, use_processes=False, **kwargs):
         super(Dcryptor, self).__init__(*args, **kwargs)
+        self.workers = workers
+        self.use_processes = use_processes
+        self.header = None
         try:
             self.file_in_size = self.inputfilestream.getbuffer().nbytes
         except AttributeError:
-            self.file_in_size = os.path.getsize(self.input_filename)
-        self.encrypted_data_size = self.file_in_size - self.SALT_LENGTH - self.NONCE_LENGTH - self.TAG_LENGTH
+            # None for streams of unknown length, which are decrypted with iter_decryption
+            self.file_in_size = os.path.getsize(self.input_filename) if self.input_filename else None
+        if self.file_in_size is not None:
+            self.encrypted_data_size = self.file_in_size - self.SALT_LENGTH - self.NONCE_LENGTH - self.TAG_LENGTH
 
     def verify(self, file_in):
         # Verify encrypted file is correct; assume we seek to the location of the tag
@@ -93,20 +234,145 @@ class Dcryptor(EncryptorBase):
         self.cipher.verify(tag)
 
     def read_and_output(self, file_in, file_out):
+        if not hasattr(file_in, 'readinto'):
+            for chunk_size in RangeAndRemainder(self.encrypted_data_size, self.BUFFER_SIZE):
+                self.read_decrypt_write(chunk_size, file_in, file_out)
+            return
+        buffer_size = max(1, min(self.BUFFER_SIZE, self.encrypted_data_size))
+        buffer, output = memoryview(bytearray(buffer_size)), memoryview(bytearray(buffer_size))
         for chunk_size in RangeAndRemainder(self.encrypted_data_size, self.BUFFER_SIZE):
-            self.read_decrypt_write(chunk_size, file_in, file_out)
+            size = file_in.readinto(buffer[:chunk_size])
+            self.cipher.decrypt(buffer[:size], output=output[:size])
+            file_out.write(output[:size])
 
     def read_decrypt_write(self, chunk_size, file_in, file_out):
         data = file_in.read(chunk_size)
         decrypted_data = self.cipher.decrypt(data)
         file_out.write(decrypted_data)
 
+    def read_segment_header(self, file_in):
+        # returns the SegmentHeader of a segmented file, or rewinds and returns None
+        magic = file_in.read(len(SegmentHeader.MAGIC))
+        if magic != SegmentHeader.MAGIC:
+            file_in.seek(0)
+            return None
+        self.header = SegmentHeader.read(file_in, magic)
+        self.salt = self.header.salt
+        return self.header
+
+    def read_and_output_segments(self, file_in, file_out):
+        header = self.header
+        key = self.get_segment_key(header)
+        body_size = self.file_in_size - header.size
+        jobs = ((decrypt_segment, key, header.segment_nonce(index, final), header.aad, data, header.aead.name)
+                for index, final, data in header.iter_encrypted_segments(file_in, body_size))
+        for plaintext in self.decompressed(run_segment_jobs(jobs, self.workers, self.use_processes)):
+            file_out.write(plaintext)
+
+    def iter_stream_segments(self, file_in):
+        header = self.header
+        key = self.get_segment_key(header)
+        jobs = ((decrypt_segment, key, header.segment_nonce(index, final), header.aad, data, header.aead.name)
+                for index, final, data in iter_lookahead(file_in, header.encrypted_segment_size))
+        return self.decompressed(run_segment_jobs(jobs, self.workers, self.use_processes))
+
+    def decompressed(self, plaintexts):
+        codec = self.header.codec
+        return plaintexts if codec is None else iter_decompressed(codec, plaintexts, self.BUFFER_SIZE)
+
+    def iter_stream_single(self, file_in, salt_start):
+        # The tag is the last TAG_LENGTH bytes, which we can't locate without the size, so the
+        # most recent TAG_LENGTH bytes are held back until the stream ends. Plaintext is
+        # released before the tag is checked: it is unverified until this generator finishes.
+        self.salt = salt_start + read_exactly(file_in, self.SALT_LENGTH - len(salt_start))
+        nonce = read_exactly(file_in, self.NONCE_LENGTH)
+        if len(nonce) != self.NONCE_LENGTH:
+            raise ValueError('Truncated header')
+        self.cipher = AES.new(self.get_key(self.salt), AES.MODE_GCM, nonce=nonce)
+        held = b''
+        while data := file_in.read(self.BUFFER_SIZE):
+            data = held + data
+            held = data[-self.TAG_LENGTH:]
+            if len(data) > self.TAG_LENGTH:
+                yield self.cipher.decrypt(data[:-self.TAG_LENGTH])
+        if len(held) != self.TAG_LENGTH:
+            raise ValueError('Truncated ciphertext')
+        self.cipher.verify(held)
+
+    def iter_decryption(self):
+        # Decrypts from a stream of unknown length (e.g. a boto3 StreamingBody) without seeking,
+        # yielding plaintext chunks as ciphertext arrives. Memory stays at a few chunks.
+        # for single-stream files the salt, nonce and key are read inside decrypt.body
+        with self.inputfilestream as file_in:
+            with span('decrypt.header'):
+                magic = read_exactly(file_in, len(SegmentHeader.MAGIC))
+                if magic == SegmentHeader.MAGIC:
+                    self.header = SegmentHeader.read(file_in, magic)
+                    self.salt = self.header.salt
+            if self.header is not None:
+                yield from span_iter('decrypt.body', self.iter_stream_segments(file_in), segmented=True)
+            else:
+                yield from span_iter('decrypt.body', self.iter_stream_single(file_in, magic), segmented=False)
+
+    def do_verification(self):
+        # Checks every tag of a file from any readable, discarding the plaintext as it goes (and
+        # skipping decompression, as the tags cover the compressed bytes). Returns the number of
+        # bytes authenticated; raises ValueError for a tampered, truncated or unreadable file.
+        verified = 0
+        with self.inputfilestream as file_in, span('decrypt.verify_only') as stage:
+            magic = read_exactly(file_in, len(SegmentHeader.MAGIC))
+            if magic != SegmentHeader.MAGIC:
+                for plaintext in self.iter_stream_single(file_in, magic):
+                    verified += len(plaintext)
+                stage.nbytes = verified
+                return verified
+            header = self.header = SegmentHeader.read(file_in, magic)
+            self.salt = header.salt
+            key = self.get_segment_key(header)
+            last = []
+
+            def jobs():
+                for index, final, data in iter_lookahead(file_in, header.encrypted_segment_size):
+                    if final:
+                        last[:] = [index, data]
+                    yield decrypt_segment, key, header.segment_nonce(index, final), header.aad, data, header.aead.name
+            try:
+                for plaintext in run_segment_jobs(jobs(), self.workers, self.use_processes):
+                    verified += len(plaintext)
+            except ValueError as error:
+                if not last:
+                    raise
+                # a last segment that only verifies as non-final means the file was cut at a segment boundary
+                try:
+                    decrypt_segment(key, header.segment_nonce(last[0], False), header.aad, last[1], header.aead.name)
+                except ValueError:
+                    raise error
+                raise ValueError('Truncated file: it ends after segment %d, which is not the final one' % last[0])
+            stage.nbytes = verified
+        return verified
+
     def do_decryption(self):
+        if self.file_in_size is None:
+            with self.outputfilestream as file_out, span('decrypt.stream') as body:
+                for plaintext in self.iter_decryption():
+                    file_out.write(plaintext)
+                body.nbytes = file_out.tell()
+                return self.return_encryption(file_out)
         with self.outputfilestream as file_out, \
                 self.inputfilestream as file_in:
-            self.read_file_in(file_in)
-            self.read_and_output(file_in, file_out)
-            self.verify(file_in)
+            with span('decrypt.header'):
+                segmented = self.read_segment_header(file_in)
+                if not segmented:
+                    self.read_file_in(file_in)
+            with span('decrypt.body', segmented=bool(segmented)) as body:
+                if segmented:
+                    self.read_and_output_segments(file_in, file_out)
+                else:
+                    self.read_and_output(file_in, file_out)
+                body.nbytes = file_out.tell()
+            if not segmented:
+                with span('decrypt.verify'):
+                    self.verify(file_in)
             return self.return_encryption(file_out)
 
 
@@ -115,11 +381,574 @@ def RangeAndRemainder(whole, chunk):
     quotent, remainder = divmod(whole, chunk)
     for _ in range(quotent):
         yield chunk
-    yield remainder
+    if remainder:
+        yield remainder
+
+
+def stream_size(stream):
+    # total size of a BytesIO or regular file, None when it can't be known up front
+    # (pipes, sockets and character devices report a size of 0)
+    try:
+        return stream.getbuffer().nbytes
+    except AttributeError:
+        pass
+    try:
+        file_stat = os.fstat(stream.fileno())
+    except (AttributeError, OSError):
+        return None
+    return file_stat.st_size if stat.S_ISREG(file_stat.st_mode) else None
+
+
+def read_exactly(stream, size):
+    # read() may return short on pipes and sockets; keep reading until size or EOF
+    data = stream.read(size)
+    if data is None or len(data) == size or not data:
+        return data or b''
+    parts = [data]
+    remaining = size - len(data)
+    while remaining and (data := stream.read(remaining)):
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def iter_lookahead(stream, size):
+    # yields (index, final, data) for consecutive size-byte blocks of a stream, reading one
+    # block ahead so the last one can be flagged; an empty stream is a single empty final block
+    index, data = 0, read_exactly(stream, size)
+    while True:
+        following = read_exactly(stream, size) if len(data) == size else b''
+        final = not following
+        yield index, final, data
+        if final:
+            return
+        index, data = index + 1, following
+
+
+class CompressionCodec:
+    # compressor/decompressor factories for one codec; bz2 and lzma are imported on first use
+    def __init__(self, codec_id, name, default_level, compressor, decompressor):
+        self.codec_id = codec_id
+        self.name = name
+        self.default_level = default_level
+        self._compressor = compressor
+        self.decompressor = decompressor
+
+    def compressor(self, level=None):
+        return self._compressor(self.default_level if level is None else level)
+
+
+COMPRESSION_CODECS = {codec.name: codec for codec in (
+    CompressionCodec(1, 'zlib', 6, zlib.compressobj, zlib.decompressobj),
+    CompressionCodec(2, 'bz2', 9, lambda level: import_module('bz2').BZ2Compressor(level),
+                     lambda: import_module('bz2').BZ2Decompressor()),
+    CompressionCodec(3, 'lzma', 6, lambda level: import_module('lzma').LZMACompressor(preset=level),
+                     lambda: import_module('lzma').LZMADecompressor()),
+)}
+COMPRESSION_CODEC_IDS = {codec.codec_id: codec for codec in COMPRESSION_CODECS.values()}
+
+
+def get_compression_codec(name):
+    if name is None or isinstance(name, CompressionCodec):
+        return name
+    try:
+        return COMPRESSION_CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown compression codec %r, expected one of %s' % (name, ', '.join(COMPRESSION_CODECS)))
+
+
+class AeadCipher:
+    # an AEAD with a 32 byte key, 12 byte nonce and 16 byte tag; new(key, nonce) returns a
+    # pycryptodome cipher object (update / encrypt_and_digest / decrypt_and_verify)
+    def __init__(self, cipher_id, name, new):
+        self.cipher_id = cipher_id
+        self.name = name
+        self.new = new
+
+
+CIPHERS = {cipher.name: cipher for cipher in (
+    AeadCipher(1, 'aes-gcm', lambda key, nonce: AES.new(key, AES.MODE_GCM, nonce=nonce)),
+    AeadCipher(2, 'chacha20-poly1305',
+               lambda key, nonce: import_module('Crypto.Cipher.ChaCha20_Poly1305').new(key=key, nonce=nonce)),
+)}
+CIPHER_IDS = {cipher.cipher_id: cipher for cipher in CIPHERS.values()}
+CIPHER_BENCHMARK_SIZE = 256 * 1024
+
+_fastest_cipher = None
+_fastest_cipher_lock = threading.Lock()
+
+
+def fastest_cipher():
+    # Times every registered cipher on a small buffer and returns the fastest. Runs once per
+    # process (a few ms); AES-GCM wins wherever the CPU has AES instructions.
+    global _fastest_cipher
+    with _fastest_cipher_lock:
+        if _fastest_cipher is None:
+            key, nonce, data = bytes(32), bytes(12), bytes(CIPHER_BENCHMARK_SIZE)
+            timings = {}
+            for cipher in CIPHERS.values():
+                rounds = []
+                for _ in range(3):
+                    start = time.perf_counter()
+                    cipher.new(key, nonce).encrypt_and_digest(data)
+                    rounds.append(time.perf_counter() - start)
+                timings[cipher.name] = min(rounds)
+            _fastest_cipher = CIPHERS[min(timings, key=timings.get)]
+        return _fastest_cipher
+
+
+def get_cipher(name):
+    # a registered cipher by name, or the fastest one on this host for 'auto'
+    if isinstance(name, AeadCipher):
+        return name
+    if name == 'auto':
+        return fastest_cipher()
+    try:
+        return CIPHERS[name]
+    except KeyError:
+        raise ValueError('Unknown cipher %r, expected auto or one of %s' % (name, ', '.join(CIPHERS)))
+
+
+class SegmentHeader:
+    # Segmented container, version 1:
+    #   MAGIC (4) | version (1) | segment size (4, big endian) | salt (32) | nonce prefix (7)
+    # followed by segments of `segment size` plaintext bytes, each sealed with AES-GCM as
+    # ciphertext + tag. Segment i uses the nonce  prefix | i (4, big endian) | final flag (1),
+    # and the header is authenticated with every segment. Only the last segment is sealed
+    # with the final flag set, so dropping or reordering trailing segments fails the tag check.
+    # Version 2 appends a codec id (1) to the header: the plaintext was compressed as one
+    # stream with that codec before being cut into segments.
+    # Version 3 appends a cipher id (1) and a codec id (1, 0 for none) instead: segments are
+    # sealed with that AEAD. AES-GCM files keep the version 1 or 2 header.
+    # Version 4 (envelope) follows the version 3 fields with a wrapped data key (60): the
+    # segments are sealed with a random per-object key, AES-GCM wrapped as nonce (12) |
+    # key (32) | tag (16) under a master key derived from the password and salt.
+    MAGIC = b'ENKS'
+    VERSION = 1
+    COMPRESSED_VERSION = 2
+    CIPHER_VERSION = 3
+    ENVELOPE_VERSION = 4
+    NONCE_PREFIX_LENGTH = 7
+    TAG_LENGTH = EncryptorBase.TAG_LENGTH
+    SALT_LENGTH = EncryptorBase.SALT_LENGTH
+    WRAPPED_KEY_LENGTH = 12 + EncryptorBase.KEY_LENGTH + TAG_LENGTH
+    FORMAT = '>4sBI%ds%ds' % (SALT_LENGTH, NONCE_PREFIX_LENGTH)
+    # bytes following FORMAT
+    EXTRA_LENGTHS = {VERSION: 0, COMPRESSED_VERSION: 1, CIPHER_VERSION: 2, ENVELOPE_VERSION: 2 + WRAPPED_KEY_LENGTH}
+    MAX_SIZE = struct.calcsize(FORMAT) + max(EXTRA_LENGTHS.values())
+    MAX_SEGMENTS = 2 ** 32
+
+    def __init__(self, segment_size, salt, nonce_prefix, codec=None, aead=None, wrapped_key=None):
+        self.aead = aead or CIPHERS['aes-gcm']
+        if wrapped_key is not None:
+            self.version = self.ENVELOPE_VERSION
+        elif self.aead is not CIPHERS['aes-gcm']:
+            self.version = self.CIPHER_VERSION
+        else:
+            self.version = self.VERSION if codec is None else self.COMPRESSED_VERSION
+        self.segment_size = segment_size
+        self.salt = salt
+        self.nonce_prefix = nonce_prefix
+        self.codec = codec
+        self.wrapped_key = wrapped_key
+        self.aad = self.pack()
+        self.size = len(self.aad)
+
+    def pack(self):
+        packed = struct.pack(self.FORMAT, self.MAGIC, self.version, self.segment_size, self.salt, self.nonce_prefix)
+        if self.version in (self.CIPHER_VERSION, self.ENVELOPE_VERSION):
+            packed += bytes([self.aead.cipher_id, self.codec.codec_id if self.codec else 0])
+        elif self.version == self.COMPRESSED_VERSION:
+            packed += bytes([self.codec.codec_id])
+        if self.version == self.ENVELOPE_VERSION:
+            packed += self.wrapped_key
+        return packed
+
+    @classmethod
+    def read(cls, file_in, magic=b''):
+        raw = magic + read_exactly(file_in, struct.calcsize(cls.FORMAT) - len(magic))
+        if len(raw) != struct.calcsize(cls.FORMAT):
+            raise ValueError('Truncated segment header')
+        magic, version, segment_size, salt, nonce_prefix = struct.unpack(cls.FORMAT, raw)
+        if magic != cls.MAGIC or version not in cls.EXTRA_LENGTHS:
+            raise ValueError('Unsupported segmented format version %s' % version)
+        if not segment_size:
+            raise ValueError('Invalid segment size 0')
+        extra = read_exactly(file_in, cls.EXTRA_LENGTHS[version])
+        if len(extra) != cls.EXTRA_LENGTHS[version]:
+            raise ValueError('Truncated segment header')
+        aead, codec, codec_id, wrapped_key = CIPHERS['aes-gcm'], None, 0, None
+        if version == cls.COMPRESSED_VERSION:
+            codec_id = extra[0]
+        elif version in (cls.CIPHER_VERSION, cls.ENVELOPE_VERSION):
+            aead = CIPHER_IDS.get(extra[0])
+            if aead is None:
+                raise ValueError('Unsupported cipher id %d' % extra[0])
+            codec_id = extra[1]
+            if version == cls.ENVELOPE_VERSION:
+                wrapped_key = extra[2:]
+        if codec_id:
+            codec = COMPRESSION_CODEC_IDS.get(codec_id)
+            if codec is None:
+                raise ValueError('Unsupported compression codec id %d' % codec_id)
+        return cls(segment_size, salt, nonce_prefix, codec, aead, wrapped_key)
+
+    @property
+    def encrypted_segment_size(self):
+        return self.segment_size + self.TAG_LENGTH
+
+    def segment_nonce(self, index, final):
+        if index >= self.MAX_SEGMENTS:
+            raise ValueError('Too many segments for one file')
+        return self.nonce_prefix + struct.pack('>IB', index, final)
 
+    def segment_count(self, body_size):
+        # an empty plaintext is still one (final) segment holding just a tag
+        return max(1, -(-body_size // self.encrypted_segment_size))
 
-s3 = S3Utils()
-s3.set_default_bucket(bucket_name='zappa-encode')
+    def plaintext_size(self, body_size):
+        return body_size - self.segment_count(body_size) * self.TAG_LENGTH
+
+    def encrypted_range(self, offset, length, body_size):
+        # maps a plaintext range onto the segments covering it:
+        # returns (first segment index, first byte, last byte) with byte offsets from the start of the file
+        first = offset // self.segment_size
+        last = (offset + length - 1) // self.segment_size
+        start = self.size + first * self.encrypted_segment_size
+        end = self.size + min((last + 1) * self.encrypted_segment_size, body_size) - 1
+        return first, start, end
+
+    def iter_encrypted_segments(self, file_in, body_size):
+        count = self.segment_count(body_size)
+        for index in range(count):
+            final = index == count - 1
+            size = body_size - index * self.encrypted_segment_size if final else self.encrypted_segment_size
+            data = read_exactly(file_in, size)
+            if len(data) != size or size < self.TAG_LENGTH:
+                raise ValueError('Truncated segment %d' % index)
+            yield index, final, data
+
+
+data_key_cache = KeyCache(DATA_KEY_CACHE_SIZE)
+
+
+def wrap_data_key(master_key, data_key):
+    nonce = get_random_bytes(12)
+    cipher = AES.new(master_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(SegmentHeader.MAGIC)
+    wrapped, tag = cipher.encrypt_and_digest(data_key)
+    wrapped_key = nonce + wrapped + tag
+    data_key_cache.get_or_create((master_key, wrapped_key), lambda: data_key)  # reading our own writes is free
+    return wrapped_key
+
+
+def unwrap_data_key(master_key, wrapped_key):
+    def unwrap():
+        with span('kdf.unwrap'):
+            cipher = AES.new(master_key, AES.MODE_GCM, nonce=wrapped_key[:12])
+            cipher.update(SegmentHeader.MAGIC)
+            return cipher.decrypt_and_verify(wrapped_key[12:-SegmentHeader.TAG_LENGTH],
+                                             wrapped_key[-SegmentHeader.TAG_LENGTH:])
+    return data_key_cache.get_or_create((master_key, bytes(wrapped_key)), unwrap)
+
+
+def encrypt_segment(key, nonce, aad, data, cipher_name='aes-gcm'):
+    # the cipher travels by name, so jobs stay picklable for process pools
+    cipher = CIPHERS[cipher_name].new(key, nonce)
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def decrypt_segment(key, nonce, aad, data, cipher_name='aes-gcm'):
+    cipher = CIPHERS[cipher_name].new(key, nonce)
+    cipher.update(aad)
+    tag_start = len(data) - SegmentHeader.TAG_LENGTH
+    if tag_start < 0:
+        raise ValueError('Truncated segment')
+    return cipher.decrypt_and_verify(data[:tag_start], data[tag_start:])
+
+
+class CompressingReader:
+    # File-like view of a stream's bytes after compression (or as-is when compressor is None),
+    # so the compressed stream can be cut into segments like plaintext. `head` is data
+    # already read from the stream, e.g. the compression sample.
+    def __init__(self, file_in, compressor, chunk_size, head=b''):
+        self.file_in = file_in
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.head = head
+        self.pending = bytearray()
+        self.done = False
+
+    def read(self, size):
+        while len(self.pending) < size and not self.done:
+            data, self.head = self.head or self.file_in.read(self.chunk_size), b''
+            if self.compressor is None:
+                self.pending += data
+                self.done = not data
+            elif data:
+                self.pending += self.compressor.compress(data)
+            else:
+                self.pending += self.compressor.flush()
+                self.done = True
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+
+def iter_decompressed(codec, chunks, max_length):
+    # Decompresses a stream of chunks, producing at most max_length bytes per call so a
+    # highly compressed segment can't balloon memory.
+    decompressor = codec.decompressor()
+    for data in chunks:
+        while True:
+            output = decompressor.decompress(data, max_length)
+            if output:
+                yield output
+            if hasattr(decompressor, 'unconsumed_tail'):  # zlib
+                data = decompressor.unconsumed_tail
+                if not data and len(output) < max_length:
+                    break
+            elif decompressor.eof or decompressor.needs_input:
+                break
+            else:
+                data = b''
+    if hasattr(decompressor, 'flush') and (output := decompressor.flush()):
+        yield output
+    if not decompressor.eof:
+        raise ValueError('Truncated compressed stream')
+
+
+def run_segment_jobs(jobs, workers=None, use_processes=False):
+    # Runs (func, *args) jobs on a pool and yields results in submission order. At most
+    # 2 * workers jobs are in flight, so memory stays bounded however large the file is.
+    # pycryptodome releases the GIL inside AES, so threads already spread over cores.
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for func, *args in jobs:
+            yield func(*args)
+        return
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        pending = deque()
+        for func, *args in jobs:
+            pending.append(pool.submit(func, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fetch_segment_header(s3, key, bucket_name=None):
+    # returns (SegmentHeader, or None for the single-stream format, size of the whole object)
+    # with one small ranged GET
+    raw_header, object_size = s3.get_object_range(key, 0, SegmentHeader.MAX_SIZE - 1, bucket_name=bucket_name)
+    if not raw_header.startswith(SegmentHeader.MAGIC):
+        return None, object_size
+    return SegmentHeader.read(io.BytesIO(raw_header)), object_size
+
+
+def iter_range(s3, key, offset, length, bucket_name=None, dcryptor_class=None, workers=None, header=None,
+               object_size=None):
+    # Decrypts plaintext bytes [offset, offset + length) of a segmented object, fetching only the
+    # header and the segments that cover the range with S3 Range requests. Returns an iterator
+    # of plaintext chunks, one per segment, each verified before it is released; the segments
+    # are streamed, so memory stays at a few segments however long the range is.
+    # Pass header and object_size from fetch_segment_header to skip fetching the header again.
+    dcryptor_class = dcryptor_class or Dcryptor
+    if header is None:
+        with span('decrypt.header'):
+            header, object_size = fetch_segment_header(s3, key, bucket_name=bucket_name)
+    if header is None:
+        raise ValueError('%s is not in the segmented format; download it whole instead' % key)
+    if header.codec is not None:
+        raise ValueError('%s is compressed, so plaintext offsets are unknown; download it whole instead' % key)
+    body_size = object_size - header.size
+    length = min(length, header.plaintext_size(body_size) - offset)
+    if offset < 0 or length <= 0:
+        return iter(())
+    first, start, end = header.encrypted_range(offset, length, body_size)
+    body = s3.get_object_stream(key, bucket_name=bucket_name, start=start, end=end)
+    key_bytes = dcryptor_class.get_segment_key(header)
+    count = header.segment_count(body_size)
+    segments = header.iter_encrypted_segments(body, end - start + 1)
+    jobs = ((decrypt_segment, key_bytes, header.segment_nonce(first + index, first + index == count - 1), header.aad,
+             sealed, header.aead.name)
+            for index, _, sealed in segments)
+    return span_iter('decrypt.body', trim_range(run_segment_jobs(jobs, workers), offset - first * header.segment_size,
+                                                length), segmented=True, range=True)
+
+
+def trim_range(chunks, skip, length):
+    # drops the first `skip` bytes of a chunk stream and stops after `length` more
+    for chunk in chunks:
+        if skip >= len(chunk):
+            skip -= len(chunk)
+            continue
+        chunk = chunk[skip:skip + length]
+        skip = 0
+        length -= len(chunk)
+        yield chunk
+        if not length:
+            return
+
+
+def read_range(s3, key, offset, length, bucket_name=None, dcryptor_class=None, workers=None):
+    return b''.join(iter_range(s3, key, offset, length, bucket_name, dcryptor_class, workers))
+
+
+class SegmentedEncryptor(Encryptor):
+    SEGMENT_SIZE = 1024 * 1024  # plaintext bytes per independently sealed segment
+    COMPRESSION = os.getenv('ENKRYPT_COMPRESSION') or None  # 'zlib', 'bz2' or 'lzma' to compress before encrypting
+    COMPRESSION_SAMPLE_SIZE = 64 * 1024
+    COMPRESSION_MIN_SAVING = 0.1  # compress only if a fast pass over the sample saves this fraction
+    # a name from CIPHERS, or 'auto' for the fastest one on this host (measured once per process)
+    CIPHER = os.getenv('ENKRYPT_CIPHER') or 'aes-gcm'
+    # Seal each object with its own random data key, stored wrapped in the header (version 4).
+    # Segments are told apart only by a 7-byte random nonce prefix, so files must never share
+    # a key: ENKRYPT_ENVELOPE=0 (for readers that predate version 4) instead derives the key
+    # from a fresh salt per file, which costs a full scrypt run per write.
+    ENVELOPE = os.getenv('ENKRYPT_ENVELOPE', '1') not in ('', '0')
+
+    def __init__(self, *args, segment_size=None, workers=None, use_processes=False, compression=None,
+                 compression_level=None, cipher=None, envelope=None, **kwargs):
+        super(SegmentedEncryptor, self).__init__(*args, **kwargs)
+        wrapped_key = None
+        if self.ENVELOPE if envelope is None else envelope:
+            self.key = get_random_bytes(self.KEY_LENGTH)
+            wrapped_key = wrap_data_key(self.get_master_key(self.salt), self.key)
+        else:
+            if kwargs.get('salt') is None:
+                self.salt = get_random_bytes(self.SALT_LENGTH)
+            self.key = self.get_key(self.salt)
+        self.header = SegmentHeader(segment_size or self.SEGMENT_SIZE, self.salt,
+                                    get_random_bytes(SegmentHeader.NONCE_PREFIX_LENGTH),
+                                    aead=get_cipher(cipher or self.CIPHER), wrapped_key=wrapped_key)
+        self.workers = workers
+        self.use_processes = use_processes
+        self.compression = get_compression_codec(compression or self.COMPRESSION)
+        self.compression_level = compression_level
+        self.sample = b''
+
+    def choose_codec(self):
+        # Reads the first chunk and keeps the codec only if the sample compresses; already
+        # compressed or random data is stored as-is (version 1 header) without paying for it.
+        if self.compression is None:
+            return None
+        self.sample = read_exactly(self.inputfilestream, self.COMPRESSION_SAMPLE_SIZE)
+        if len(zlib.compress(self.sample, 1)) > len(self.sample) * (1 - self.COMPRESSION_MIN_SAVING):
+            return None
+        return self.compression
+
+    def write_header(self, file_out):
+        codec = self.choose_codec()
+        if codec is not None:
+            self.header = SegmentHeader(self.header.segment_size, self.salt, self.header.nonce_prefix, codec,
+                                        self.header.aead, self.header.wrapped_key)
+        file_out.write(self.header.aad)
+
+    def write_body(self, file_in, file_out):
+        for sealed in self.iter_body(file_in):
+            file_out.write(sealed)
+
+    def iter_body(self, file_in):
+        header = self.header
+        if header.codec is not None or self.sample:
+            compressor = header.codec and header.codec.compressor(self.compression_level)
+            file_in = CompressingReader(file_in, compressor, self.BUFFER_SIZE, self.sample)
+        jobs = ((encrypt_segment, self.key, header.segment_nonce(index, final), header.aad, data, header.aead.name)
+                for index, final, data in iter_lookahead(file_in, header.segment_size))
+        return run_segment_jobs(jobs, self.workers, self.use_processes)
+
+    def write_footer(self, file_out):
+        # every segment carries its own tag
+        pass
+
+
+def encrypt_bytes(data, salt=None, encryptor_class=None):
+    # One-shot single-stream encryption for small payloads: no streams, no chunk loop, and
+    # the result (salt | nonce | ciphertext | tag) is built in a single bytearray.
+    encryptor_class = encryptor_class or Encryptor
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    salt = salt or encryptor_class.get_process_salt()
+    nonce = get_random_bytes(encryptor_class.NONCE_LENGTH)
+    cipher = AES.new(encryptor_class.get_key(salt), AES.MODE_GCM, nonce=nonce)
+    header_size = encryptor_class.SALT_LENGTH + encryptor_class.NONCE_LENGTH
+    body_end = header_size + len(data)
+    result = bytearray(body_end + encryptor_class.TAG_LENGTH)
+    result[:encryptor_class.SALT_LENGTH] = salt
+    result[encryptor_class.SALT_LENGTH:header_size] = nonce
+    cipher.encrypt(data, output=memoryview(result)[header_size:body_end])
+    result[body_end:] = cipher.digest()
+    return result
+
+
+def decrypt_bytes(data, dcryptor_class=None):
+    # One-shot counterpart of encrypt_bytes; also accepts the segmented format.
+    dcryptor_class = dcryptor_class or Dcryptor
+    data = memoryview(data)
+    if data[:len(SegmentHeader.MAGIC)] == SegmentHeader.MAGIC:
+        with span('decrypt.header'):
+            header = SegmentHeader.read(io.BytesIO(data[:SegmentHeader.MAX_SIZE]))
+            key = dcryptor_class.get_segment_key(header)
+        with span('decrypt.body', segmented=True) as body:
+            body_size = len(data) - header.size
+            result = bytearray(header.plaintext_size(body_size))
+            position = 0
+            output = memoryview(result)
+            for index, final, sealed in header.iter_encrypted_segments(io.BytesIO(data[header.size:]), body_size):
+                size = len(sealed) - header.TAG_LENGTH
+                cipher = header.aead.new(key, header.segment_nonce(index, final))
+                cipher.update(header.aad)
+                cipher.decrypt(sealed[:size], output=output[position:position + size])
+                cipher.verify(sealed[size:])
+                position += size
+            if header.codec is not None:
+                result = bytearray().join(iter_decompressed(header.codec, [result], dcryptor_class.BUFFER_SIZE))
+            body.nbytes = len(result)
+        return result
+    header_size = dcryptor_class.SALT_LENGTH + dcryptor_class.NONCE_LENGTH
+    body_end = len(data) - dcryptor_class.TAG_LENGTH
+    if body_end < header_size:
+        raise ValueError('Truncated ciphertext')
+    with span('decrypt.header'):
+        cipher = AES.new(dcryptor_class.get_key(bytes(data[:dcryptor_class.SALT_LENGTH])), AES.MODE_GCM,
+                         nonce=data[dcryptor_class.SALT_LENGTH:header_size])
+    with span('decrypt.body', segmented=False) as body:
+        result = bytearray(body_end - header_size)
+        cipher.decrypt(data[header_size:body_end], output=result)
+        body.nbytes = len(result)
+    with span('decrypt.verify'):
+        cipher.verify(data[body_end:])
+    return result
+
+
+def download_decrypt(s3, key, bucket_name=None, dcryptor_class=None, **kwargs):
+    # Yields plaintext chunks while the object is still downloading; nothing is buffered whole.
+    dcryptor_class = dcryptor_class or Dcryptor
+    body = s3.get_object_stream(key, bucket_name=bucket_name)
+    return dcryptor_class(input_stream=body, **kwargs).iter_decryption()
+
+
+def encrypt_upload(s3, key, source, bucket_name=None, encryptor_class=None, **kwargs):
+    # Encrypts str/bytes or any readable straight into an S3 multipart upload, no temp file.
+    encryptor_class = encryptor_class or SegmentedEncryptor
+    if hasattr(source, 'read'):
+        encryptor = encryptor_class(input_stream=source, **kwargs)
+    else:
+        encryptor = encryptor_class(input_string=source, **kwargs)
+    s3.upload_stream(key, encryptor.iter_encryption(), bucket_name=bucket_name)
+
+
+TEST_BUCKET = 'zappa-encode'
+
+
+def get_test_s3():
+    s3 = S3Utils()
+    s3.set_default_bucket(bucket_name=TEST_BUCKET)
+    return s3
 
 
 def encode_string_then_decode():
@@ -129,12 +958,8 @@ def encode_string_then_decode():
     assert (input_string == final_str)
 
 
-encode_string_then_decode()
-
-
 def upload_downloader():
-    s3 = S3Utils()
-    s3.set_default_bucket(bucket_name='zappa-encode')
+    s3 = get_test_s3()
     key = 'upload_download.txt'
     s3.upload_file(key=key, file_path='src3.txt')
     s3.download_file(key=key, file_path='t2_downloaded.txt')
@@ -142,10 +967,8 @@ def upload_downloader():
         assert (t2.read() == t2b.read())
 
 
-upload_downloader()
-
-
 def encode_string_upload_then_download():
+    s3 = get_test_s3()
     input_string = b'testencrypt'
     input_fn = 'src3.txt'
     with open('%s' % input_fn, 'wb') as src:
@@ -160,10 +983,8 @@ def encode_string_upload_then_download():
         assert (t1b == t2b)
 
 
-encode_string_upload_then_download()
-
-
 def encode_string_upload_then_download_then_decode():
+    s3 = get_test_s3()
     input_string = b'testencrypt'
     input_fn = 'src3.txt'
     with open('%s' % input_fn, 'wb') as src:
@@ -190,4 +1011,24 @@ event = {'body': 'testencrypt', 'headers': {'Accept': '*/*', 'Accept-Encoding':
                                          'sourceIp': '127.0.0.1', 'user': None, 'userAgent': 'Custom User Agent String', 'userArn': None}, 'path': '/hello', 'protocol': 'HTTP/1.1',
                             'requestId': 'bab73187-bc8d-48b4-9d72-065886b23467', 'requestTime': '16/May/2021:11:37:04 +0000', 'requestTimeEpoch': 1621165024, 'resourceId': '123456',
                             'resourcePath': '/hello', 'stage': 'Prod'}, 'resource': '/hello', 'stageVariables': None, 'version': '1.0'}
-encode_string_upload_then_download_then_decode()
+
+
+def encode_stream_upload_then_download_then_decode():
+    s3 = get_test_s3()
+    input_string = b'testencrypt' * 1024
+    key = 'stream_upload.txt.encrypted'
+    encrypt_upload(s3, key, io.BytesIO(input_string))
+    assert (Dcryptor(input_string=s3.get_object(key=key)).do_decryption() == input_string)
+
+
+def run_self_tests():
+    # these round-trip through the real bucket, so they only run when asked for
+    encode_string_then_decode()
+    upload_downloader()
+    encode_string_upload_then_download()
+    encode_string_upload_then_download_then_decode()
+    encode_stream_upload_then_download_then_decode()
+
+
+if __name__ == '__main__':
+    run_self_tests()
@@ -0,0 +1,123 @@
+"""
+Cold-start profile for the Zappa Lambda.
+
+Each measurement runs in a fresh interpreter so nothing is imported yet, the way a
+new Lambda container starts. Reports the import time of every module pulled in by
+the handler and the time until encoder_view has answered its first request.
+
+    python benchmarks/coldstart.py
+    python benchmarks/coldstart.py --method GET --key boom_key
+    python benchmarks/coldstart.py --max-init-ms 1500   # exits 1 when over budget
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DJANGO_SETTINGS = 'encode_zap.encode_zap.settings'
+HANDLER_MODULE = 'encoder.views'
+
+
+def child_env():
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', DJANGO_SETTINGS)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')]))
+    return env
+
+
+def parse_importtime(stderr):
+    # lines look like: "import time:       261 |        261 |   encodings.aliases"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(),
+                        'self_ms': int(self_us) / 1000,
+                        'cumulative_ms': int(cumulative_us) / 1000})
+    return modules
+
+
+def profile_imports(module=HANDLER_MODULE):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            cwd=REPO_ROOT, env=child_env(), capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    return parse_importtime(result.stderr)
+
+
+def first_response(method='POST', key=None, data=None):
+    # runs inside the child interpreter
+    start = time.perf_counter()
+    import django
+    django.setup()
+    from django.test import RequestFactory
+    from encoder.views import encoder_view
+    init_done = time.perf_counter()
+    factory = RequestFactory()
+    if method == 'GET':
+        request = factory.get('/', {'key': key})
+    else:
+        request = factory.post('/', {'data': data} if data else {})
+    response = encoder_view(request)
+    responded = time.perf_counter()
+    return {'init_ms': (init_done - start) * 1000,
+            'first_response_ms': (responded - init_done) * 1000,
+            'total_ms': (responded - start) * 1000,
+            'status_code': response.status_code}
+
+
+def profile_first_response(method='POST', key=None, data=None):
+    args = [sys.executable, os.path.abspath(__file__), '--child', '--method', method]
+    if key:
+        args += ['--key', key]
+    if data:
+        args += ['--data', data]
+    result = subprocess.run(args, cwd=REPO_ROOT, env=child_env(), capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def print_report(modules, response, top):
+    print('Slowest imports under %s (cumulative ms):' % HANDLER_MODULE)
+    for row in sorted(modules, key=lambda m: m['cumulative_ms'], reverse=True)[:top]:
+        print('  %10.1f  %10.1f  %s' % (row['cumulative_ms'], row['self_ms'], row['module']))
+    print('Init (django.setup + import %s): %.1f ms' % (HANDLER_MODULE, response['init_ms']))
+    print('First encoder_view response (status %s): %.1f ms' % (response['status_code'], response['first_response_ms']))
+    print('Time to first response: %.1f ms' % response['total_ms'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', choices=['GET', 'POST'], default='POST',
+                        help='POST without data answers without touching S3; GET needs --key')
+    parser.add_argument('--key', help='object key to GET')
+    parser.add_argument('--data', help='form data to POST (stores a real object)')
+    parser.add_argument('--top', type=int, default=25, help='number of imports to list')
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    parser.add_argument('--max-init-ms', type=float, help='fail if time to first response exceeds this')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(first_response(args.method, args.key, args.data)))
+        return 0
+
+    modules = profile_imports()
+    response = profile_first_response(args.method, args.key, args.data)
+    if args.json:
+        print(json.dumps({'imports': modules, 'response': response}, indent=2))
+    else:
+        print_report(modules, response, args.top)
+    if args.max_init_ms is not None and response['total_ms'] > args.max_init_ms:
+        print('Cold start %.1f ms is over the %.1f ms budget' % (response['total_ms'], args.max_init_ms), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Benchmark suite for the crypto and S3 paths.
+
+Measures Encryptor/Dcryptor throughput across payload sizes and BUFFER_SIZE values, the
+cost of one scrypt derivation, S3Utils operations and encoder_view request latency through
+the Django test client. The S3 and view benchmarks run against a local S3 emulator
+(localstack via --local-test, or any endpoint such as moto_server via --endpoint-url) and
+are skipped when neither is given, so they never touch a real bucket.
+
+Results are written as JSON; --compare fails (exit 1) when a benchmark got slower than the
+baseline by more than --tolerance.
+
+    python benchmarks/run.py --output bench.json
+    python benchmarks/run.py --endpoint-url http://localhost:4566 --output bench.json
+    python benchmarks/run.py --only crypto --compare baseline.json --tolerance 0.15
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from Enkrypt import Dcryptor, Encryptor, SegmentedEncryptor, decrypt_bytes, encrypt_bytes  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+BENCH_BUCKET = 'zappa-encode'  # the bucket encoder_view writes to
+PAYLOAD_SIZES = [1 * KB, 64 * KB, 1 * MB, 16 * MB]
+BUFFER_SIZES = [64 * KB, 1 * MB, 4 * MB]
+
+
+def measure(run, repeat=5, number=1):
+    # seconds per call: min and median over `repeat` runs of `number` calls
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append((time.perf_counter() - start) / number)
+    return {'min_s': min(timings), 'median_s': statistics.median(timings)}
+
+
+def result(group, name, timing, nbytes=None, **params):
+    row = {'group': group, 'name': name, 'params': params, **timing}
+    if nbytes:
+        row['mb_per_s'] = nbytes / timing['min_s'] / MB
+    return row
+
+
+def calls_for(size):
+    return max(1, (4 * MB) // size)
+
+
+def bench_crypto(repeat):
+    rows = []
+    Encryptor.get_key(Encryptor.get_process_salt())  # scrypt is measured on its own
+    original_buffer_size = Encryptor.BUFFER_SIZE
+    try:
+        for buffer_size in BUFFER_SIZES:
+            Encryptor.BUFFER_SIZE = Dcryptor.BUFFER_SIZE = buffer_size
+            for size in PAYLOAD_SIZES:
+                payload = os.urandom(size)
+                encrypted = Encryptor(input_string=payload).do_encryption()
+                number = calls_for(size)
+                rows.append(result('crypto', 'encrypt', measure(
+                    lambda: Encryptor(input_string=payload).do_encryption(), repeat, number),
+                    size, size=size, buffer_size=buffer_size))
+                rows.append(result('crypto', 'decrypt', measure(
+                    lambda: Dcryptor(input_string=encrypted).do_decryption(), repeat, number),
+                    size, size=size, buffer_size=buffer_size))
+    finally:
+        Encryptor.BUFFER_SIZE = Dcryptor.BUFFER_SIZE = original_buffer_size
+    for size in PAYLOAD_SIZES:
+        payload = os.urandom(size)
+        number = calls_for(size)
+        segmented = SegmentedEncryptor(input_string=payload).do_encryption()
+        rows.append(result('crypto', 'segmented_encrypt', measure(
+            lambda: SegmentedEncryptor(input_string=payload).do_encryption(), repeat, number), size, size=size))
+        rows.append(result('crypto', 'segmented_decrypt', measure(
+            lambda: Dcryptor(input_string=segmented).do_decryption(), repeat, number), size, size=size))
+        if size <= 64 * KB:
+            encrypted = bytes(encrypt_bytes(payload))
+            rows.append(result('crypto', 'encrypt_bytes', measure(
+                lambda: encrypt_bytes(payload), repeat, number), size, size=size))
+            rows.append(result('crypto', 'decrypt_bytes', measure(
+                lambda: decrypt_bytes(encrypted), repeat, number), size, size=size))
+    return rows
+
+
+def bench_scrypt(repeat):
+    from Crypto.Protocol.KDF import scrypt
+    # uncached, as paid once per new salt
+    return [result('kdf', 'scrypt', measure(
+        lambda: scrypt(Encryptor.password, os.urandom(Encryptor.SALT_LENGTH), key_len=Encryptor.KEY_LENGTH,
+                       N=Encryptor.KDF_N, r=Encryptor.KDF_R, p=Encryptor.KDF_P), min(repeat, 3)),
+        N=Encryptor.KDF_N, r=Encryptor.KDF_R, p=Encryptor.KDF_P)]
+
+
+def make_s3(args):
+    from s3_wrapper import S3Utils
+    s3 = S3Utils(LOCAL_TEST=args.local_test, endpoint_url=args.endpoint_url)
+    s3.set_default_bucket(BENCH_BUCKET)
+    try:
+        s3._s3_client.create_bucket(Bucket=BENCH_BUCKET)
+    except Exception as e:
+        if 'BucketAlready' not in type(e).__name__ and 'BucketAlready' not in str(e):
+            raise
+    return s3
+
+
+def bench_s3(args, repeat):
+    s3 = make_s3(args)
+    prefix = 'bench/%s/' % uuid.uuid4().hex
+    rows = []
+    for size in [1 * KB, 1 * MB]:
+        payload = os.urandom(size)
+        key = prefix + 'object-%d' % size
+        number = 20 if size <= KB else 3
+        rows.append(result('s3', 'create_object', measure(lambda: s3.create_object(key, payload), repeat, number),
+                           size, size=size))
+        rows.append(result('s3', 'get_object', measure(lambda: s3.get_object(key), repeat, number), size, size=size))
+        rows.append(result('s3', 'upload_stream', measure(
+            lambda: s3.upload_stream(key, io.BytesIO(payload)), repeat, number), size, size=size))
+    rows.append(result('s3', 'file_exists', measure(
+        lambda: s3.file_exists(prefix + 'object-1024', use_cache=False), repeat, 20)))
+    keys = [prefix + 'many-%04d' % i for i in range(200)]
+    for key in keys:
+        s3.create_object(key, b'x')
+    rows.append(result('s3', 'exists_many', measure(lambda: s3.exists_many(keys, use_cache=False), repeat), keys=len(keys)))
+    rows.append(result('s3', 'iter_keys', measure(lambda: sum(1 for _ in s3.iter_keys(prefix)), repeat)))
+    s3.delete_prefix(prefix)
+    return rows
+
+
+def bench_view(args, repeat):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'encode_zap.encode_zap.settings')
+    if args.endpoint_url:
+        os.environ['S3_ENDPOINT_URL'] = args.endpoint_url
+    make_s3(args)
+    import django
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    django.setup()
+    setup_test_environment()
+    client = Client()
+    key = client.post('/', {'data': 'benchmark'}).content.decode()
+    from encoder.views import decrypted_cache
+    rows = [result('view', 'encoder_view_post', measure(lambda: client.post('/', {'data': 'benchmark'}), repeat, 10))]
+
+    def uncached_get():
+        decrypted_cache.clear()
+        client.get('/', {'key': key})
+    rows.append(result('view', 'encoder_view_get', measure(uncached_get, repeat, 10), cache='cold'))
+    rows.append(result('view', 'encoder_view_get', measure(lambda: client.get('/', {'key': key}), repeat, 10),
+                       cache='warm'))
+    return rows
+
+
+def compare(rows, baseline_path, tolerance):
+    # returns the benchmarks whose min time grew by more than tolerance
+    with open(baseline_path) as file_in:
+        baseline = {(row['group'], row['name'], json.dumps(row['params'], sort_keys=True)): row
+                    for row in json.load(file_in)['results']}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row['group'], row['name'], json.dumps(row['params'], sort_keys=True)))
+        if before and row['min_s'] > before['min_s'] * (1 + tolerance):
+            regressions.append({'group': row['group'], 'name': row['name'], 'params': row['params'],
+                                'baseline_s': before['min_s'], 'current_s': row['min_s'],
+                                'slowdown': row['min_s'] / before['min_s'] - 1})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=['crypto', 'kdf', 's3', 'view'],
+                        default=['crypto', 'kdf', 's3', 'view'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--endpoint-url', default=os.getenv('S3_ENDPOINT_URL'), help='local S3 emulator endpoint')
+    parser.add_argument('--local-test', action='store_true', help='use localstack through localstack_client')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed slowdown before failing')
+    args = parser.parse_args(argv)
+
+    has_emulator = bool(args.endpoint_url or args.local_test)
+    rows, skipped = [], []
+    for group in args.only:
+        if group in ('s3', 'view') and not has_emulator:
+            skipped.append(group)
+            continue
+        runner = {'crypto': lambda: bench_crypto(args.repeat), 'kdf': lambda: bench_scrypt(args.repeat),
+                  's3': lambda: bench_s3(args, args.repeat), 'view': lambda: bench_view(args, args.repeat)}[group]
+        group_rows = runner()
+        rows.extend(group_rows)
+        for row in group_rows:
+            print('%-6s %-20s %-45s %10.3f ms%s' % (
+                row['group'], row['name'], json.dumps(row['params'], sort_keys=True), row['min_s'] * 1000,
+                '  %8.1f MB/s' % row['mb_per_s'] if 'mb_per_s' in row else ''))
+    if skipped:
+        print('skipped %s: no --endpoint-url or --local-test given' % ', '.join(skipped), file=sys.stderr)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': platform.python_version(), 'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+              'skipped': skipped, 'results': rows}
+    if args.output:
+        with open(args.output, 'w') as file_out:
+            json.dump(report, file_out, indent=2)
+    if args.compare:
+        regressions = compare(rows, args.compare, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %(group)s %(name)s %(params)s: %(baseline_s).6fs -> %(current_s).6fs' % regression,
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""
+Per-call cost of encrypting and decrypting small payloads through the stream-based
+Encryptor/Dcryptor versus the one-shot encrypt_bytes/decrypt_bytes.
+
+    python benchmarks/small_payload.py --sizes 64 512 1024 --number 20000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Enkrypt import Dcryptor, Encryptor, decrypt_bytes, encrypt_bytes  # noqa: E402
+
+
+def per_call_us(run, number):
+    return min(timeit.repeat(run, number=number, repeat=3)) / number * 1e6
+
+
+def compare(size, number):
+    payload = os.urandom(size)
+    encrypted = bytes(encrypt_bytes(payload))
+    stream_encrypt = per_call_us(lambda: Encryptor(input_string=payload).do_encryption(), number)
+    oneshot_encrypt = per_call_us(lambda: encrypt_bytes(payload), number)
+    stream_decrypt = per_call_us(lambda: Dcryptor(input_string=encrypted).do_decryption(), number)
+    oneshot_decrypt = per_call_us(lambda: decrypt_bytes(encrypted), number)
+    return [('encrypt', stream_encrypt, oneshot_encrypt), ('decrypt', stream_decrypt, oneshot_decrypt)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 1024])
+    parser.add_argument('--number', type=int, default=10000, help='calls per timing run')
+    args = parser.parse_args(argv)
+    Encryptor.get_key(Encryptor.get_process_salt())  # keep scrypt out of the timings
+    print('%8s %-8s %12s %12s %8s' % ('bytes', 'op', 'stream us', 'one-shot us', 'saved'))
+    for size in args.sizes:
+        for op, stream, oneshot in compare(size, args.number):
+            print('%8d %-8s %12.2f %12.2f %7.0f%%' % (size, op, stream, oneshot, (1 - oneshot / stream) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the file-to-file encrypt/decrypt loops before and after moving to reused
+readinto/output buffers: throughput and peak Python heap per run.
+
+    python benchmarks/zero_copy.py --size-mb 512
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Enkrypt import Dcryptor, Encryptor  # noqa: E402
+
+
+class AllocatingEncryptor(Encryptor):
+    # the loop write_body used to run: a new bytes per read() and per encrypt()
+    def write_body(self, file_in, file_out):
+        for encrypted_data in self.iter_body(file_in):
+            file_out.write(encrypted_data)
+
+
+class AllocatingDcryptor(Dcryptor):
+    def read_and_output(self, file_in, file_out):
+        remaining = self.encrypted_data_size
+        while remaining:
+            chunk_size = min(remaining, self.BUFFER_SIZE)
+            self.read_decrypt_write(chunk_size, file_in, file_out)
+            remaining -= chunk_size
+
+
+def measure(run):
+    tracemalloc.start()
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def compare(size_mb, directory):
+    plain = os.path.join(directory, 'plain')
+    encrypted = os.path.join(directory, 'plain.encrypted')
+    decrypted = os.path.join(directory, 'plain.decrypted')
+    with open(plain, 'wb') as file_out:
+        for _ in range(size_mb):
+            file_out.write(os.urandom(1024 * 1024))
+    Encryptor.get_key(Encryptor.get_process_salt())  # keep scrypt out of the timings
+
+    rows = []
+    for label, encryptor_class, dcryptor_class in [('allocating', AllocatingEncryptor, AllocatingDcryptor),
+                                                   ('zero-copy', Encryptor, Dcryptor)]:
+        elapsed, peak = measure(lambda: encryptor_class(input_filename=plain, output_filename=encrypted).do_encryption())
+        rows.append((label, 'encrypt', elapsed, peak))
+        elapsed, peak = measure(lambda: dcryptor_class(input_filename=encrypted, output_filename=decrypted).do_decryption())
+        rows.append((label, 'decrypt', elapsed, peak))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        rows = compare(args.size_mb, directory)
+    print('%-10s %-8s %10s %14s' % ('loop', 'op', 'MB/s', 'peak heap KB'))
+    for label, op, elapsed, peak in rows:
+        print('%-10s %-8s %10.1f %14.1f' % (label, op, args.size_mb / elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
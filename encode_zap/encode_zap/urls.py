@@ -13,13 +13,22 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import os
+
 from django.contrib import admin
 from django.urls import path
 
-from encoder.views import encoder_view
+from encoder.views import (ASYNC_DOWNLOADS_SUPPORTED, batch_encoder_view, download_view, download_view_async,
+                           encoder_view)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', encoder_view, name='encoder'),
+    path('batch/', batch_encoder_view, name='batch_encoder'),
+    # asgi.py sets ENCODER_ASYNC_VIEWS, so on Django 4.2+ the download streams without tying up a
+    # thread per client; older Django can't stream from an async view and serves the sync one
+    path('download/<path:key>',
+         download_view_async if ASYNC_DOWNLOADS_SUPPORTED and os.getenv('ENCODER_ASYNC_VIEWS') else download_view,
+         name='download'),
 
 ]
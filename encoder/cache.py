@@ -0,0 +1,138 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_ITEMS = int(os.getenv('ENCODER_CACHE_MAX_ITEMS', 256))
+CACHE_MAX_BYTES = int(os.getenv('ENCODER_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+CACHE_TTL = float(os.getenv('ENCODER_CACHE_TTL', 60))  # seconds an entry is served without asking S3
+CACHE_DISK_MAX_BYTES = int(os.getenv('ENCODER_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024))
+# the disk tier survives between invocations of a warm Lambda container; on by default there
+CACHE_DIR = os.getenv('ENCODER_CACHE_DIR', '/tmp/encoder-cache' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else '')
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'etag', 'expires', 'size')
+
+    def __init__(self, value, etag, expires):
+        self.value = value
+        self.etag = etag
+        self.expires = expires
+        self.size = len(value)
+
+
+class ObjectCache(object):
+    # Read-through cache of decoded S3 objects, bounded by entry count and total bytes.
+    # Fresh entries (younger than ttl) are served without touching S3; stale ones are
+    # revalidated with If-None-Match, so an unchanged object costs a 304 round trip instead of
+    # a download. The optional disk tier keeps the raw (still encrypted) bodies, so nothing
+    # decrypted is written to /tmp.
+
+    def __init__(self, decode, max_items=CACHE_MAX_ITEMS, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL,
+                 cache_dir=CACHE_DIR, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.decode = decode
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.size = 0
+        self.hits = self.revalidated = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, s3, key, bucket_name=None):
+        cache_key = (s3.get_bucket_name(bucket_name), key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                if entry.expires > time.monotonic():
+                    self.hits += 1
+                    return entry.value
+        raw = None
+        if entry is None:
+            raw, etag = self._read_disk(cache_key)
+        else:
+            etag = entry.etag
+        body, new_etag = s3.get_object_if_changed(key, etag, bucket_name=bucket_name)
+        if body is None:
+            self.revalidated += 1
+            value = entry.value if entry is not None else self.decode(raw)
+        else:
+            self.misses += 1
+            value = self.decode(body)
+            self._write_disk(cache_key, body, new_etag)
+        self._store(cache_key, CacheEntry(value, new_etag, time.monotonic() + self.ttl))
+        return value
+
+    def invalidate(self, s3, key, bucket_name=None):
+        cache_key = (s3.get_bucket_name(bucket_name), key)
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is not None:
+                self.size -= entry.size
+        if self.cache_dir:
+            try:
+                os.remove(self._disk_path(cache_key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _store(self, cache_key, entry):
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[cache_key] = entry
+            self.size += entry.size
+            while len(self._entries) > self.max_items or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def _disk_path(self, cache_key):
+        return os.path.join(self.cache_dir, hashlib.sha256('/'.join(cache_key).encode('utf-8')).hexdigest())
+
+    def _read_disk(self, cache_key):
+        # returns (raw body, etag), or (None, None) when there is nothing on disk
+        if not self.cache_dir:
+            return None, None
+        try:
+            with open(self._disk_path(cache_key), 'rb') as file_in:
+                etag = file_in.readline().rstrip(b'\n').decode('utf-8')
+                return file_in.read(), etag
+        except FileNotFoundError:
+            return None, None
+
+    def _write_disk(self, cache_key, body, etag):
+        if not self.cache_dir or len(body) > self.disk_max_bytes:
+            return
+        path = self._disk_path(cache_key)
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as file_out:
+            file_out.write(etag.encode('utf-8') + b'\n')
+            file_out.write(body)
+        os.replace(temp_path, path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.disk_max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,34 @@
+import json
+import logging
+import time
+
+from instrumentation import collect_events, summarize
+
+logger = logging.getLogger('instrumentation')
+
+
+class TimingMiddleware(object):
+    # Collects the crypto and S3 timings of each request. The per-stage breakdown goes out in a
+    # Server-Timing header (shown by browser dev tools) and as one JSON log line per request.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with collect_events() as events:
+            request.timings = events
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+        stats = summarize(events)
+        response['Server-Timing'] = ', '.join(
+            ['%s;dur=%.3f' % (stage, row['total_s'] * 1000) for stage, row in stats.items()] +
+            ['total;dur=%.3f' % (total * 1000)])
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'metric': 'request_timing', 'method': request.method, 'path': request.path,
+                                    'status': response.status_code, 'duration_ms': round(total * 1000, 3),
+                                    'stages': {stage: {'count': row['count'],
+                                                       'duration_ms': round(row['total_s'] * 1000, 3),
+                                                       'bytes': row['bytes'], 'errors': row['errors']}
+                                               for stage, row in stats.items()}}))
+        return response
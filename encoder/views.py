@@ -1,13 +1,28 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseRedirect,
+                         JsonResponse, StreamingHttpResponse)
 from django.shortcuts import render
+import django
 import json
-from Enkrypt import Dcryptor, Encryptor
+import os
+import re
+import uuid
+from Enkrypt import (decrypt_bytes, download_decrypt, encrypt_bytes, encrypt_upload, fetch_segment_header,
+                     iter_range)
 
 from django.views.decorators.csrf import csrf_exempt
 
 from s3_wrapper import S3Utils
+from s3_wrapper.utils import NOT_FOUND_CODES
 from django import forms
-from datetime import datetime
+
+from .cache import ObjectCache
+
+BATCH_MAX_ITEMS = int(os.getenv('ENCODER_BATCH_MAX_ITEMS', 10000))
+BATCH_CONCURRENCY = int(os.getenv('ENCODER_BATCH_CONCURRENCY', 16))  # items encrypted and uploaded at once
+BATCH_MAX_ITEM_SIZE = int(os.getenv('ENCODER_BATCH_MAX_ITEM_SIZE', 100))  # characters, as EncodeForm allows
 
 
 class DecodeForm(forms.Form):
@@ -42,19 +57,170 @@ def encoder_view(request):
         form = EncodeForm(request.POST)
         if form.is_valid():
             data = form.cleaned_data['data']
-            now_key = str(datetime.now())[-4:]
+            now_key = new_key()
             save_data(data=data, key=now_key)
             return HttpResponse(now_key)
         return HttpResponse('nok post')
     if request.method == 'GET':
         key = request.GET.get('key')
-        data = load_data(key=key)
-        raw_data = json.loads(data)
-        decoded_data = decode_string(raw_data.get('message'))
+        data = load_decrypted_data(key=key)
+        decoded_data = decode_string(data.decode('utf-8'))
         return HttpResponse(decoded_data)
     return HttpResponse('nok')
 
 
+def new_key():
+    # random rather than time based, so concurrent writes never collide
+    return uuid.uuid4().hex
+
+
+def parse_batch(body, content_type):
+    # a JSON array, or NDJSON (one JSON value per line); non-string items are stored as JSON
+    text = body.decode('utf-8')
+    if content_type != 'application/x-ndjson' and text.lstrip().startswith('['):
+        items = json.loads(text)
+    else:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [item if isinstance(item, str) else json.dumps(item) for item in items]
+
+
+def store_item(s3, key, data, bucket_name):
+    # returns None, or the error that kept this item from being stored
+    try:
+        s3.create_object(key, encrypt_bytes(encode_string(data)), bucket_name=bucket_name)
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e)
+    return None
+
+
+@csrf_exempt
+def batch_encoder_view(request):
+    # Encrypts and stores every item of the request body; responds with {"keys": [...], "errors": [...]}.
+    # keys are in request order, each readable through encoder_view's GET, or null for an item
+    # that couldn't be stored, which gets an {"index": ..., "error": ...} entry in errors.
+    if request.method != 'POST':
+        return HttpResponse('nok')
+    try:
+        items = parse_batch(request.body, request.content_type)
+    except (UnicodeDecodeError, ValueError) as e:
+        return HttpResponseBadRequest('invalid batch: %s' % e)
+    if len(items) > BATCH_MAX_ITEMS:
+        return HttpResponseBadRequest('too many items: %d > %d' % (len(items), BATCH_MAX_ITEMS))
+    for index, item in enumerate(items):
+        if len(item) > BATCH_MAX_ITEM_SIZE:
+            return HttpResponseBadRequest('item %d too long: %d > %d' % (index, len(item), BATCH_MAX_ITEM_SIZE))
+    keys, errors = save_batch(items)
+    return JsonResponse({'keys': keys, 'errors': errors})
+
+
+def save_batch(items, bucket_name='zappa-encode'):
+    # returns (keys, errors): a key per item, None where storing it failed, and
+    # [{'index': ..., 'error': ...}] for those items
+    s3 = S3Utils()
+    s3.set_default_bucket(bucket_name=bucket_name)
+    keys = [new_key() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, max(1, len(keys)))) as pool:
+        results = list(pool.map(store_item, [s3] * len(keys), keys, items, [bucket_name] * len(keys)))
+    errors = []
+    for index, error in enumerate(results):
+        if error:
+            keys[index] = None
+            errors.append({'index': index, 'error': error})
+    return keys, errors
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(range_header, size):
+    # (first, last) inclusive for a single 'bytes=' range; None when the header should be
+    # ignored (absent, malformed or multiple ranges), and ValueError when it can't be satisfied
+    match = RANGE_RE.match(range_header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        first, last = max(0, size - int(match.group(2))), size - 1
+    else:
+        first = int(match.group(1))
+        last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if match.group(2) and int(match.group(2)) < first:
+            return None
+    if first >= size or last < first:
+        raise ValueError('Range not satisfiable')
+    return first, last
+
+
+def open_download(key, range_header=None, bucket_name='zappa-encode'):
+    # Returns (status, headers, plaintext chunk iterator) for the decrypted object. Ranges are
+    # served from segmented, uncompressed objects by fetching just the covering segments;
+    # other objects are streamed whole from the start. Segments are verified before they are
+    # released, but a single-stream object's tag is only checked at its end, so a tampered
+    # object aborts the response part way.
+    s3 = S3Utils()
+    s3.set_default_bucket(bucket_name=bucket_name)
+    if range_header:
+        header, object_size = fetch_segment_header(s3, key, bucket_name=bucket_name)
+        if header is not None and header.codec is None:
+            size = header.plaintext_size(object_size - header.size)
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                return 416, {'Content-Range': 'bytes */%d' % size}, iter(())
+            if byte_range is not None:
+                first, last = byte_range
+                chunks = iter_range(s3, key, first, last - first + 1, bucket_name=bucket_name, header=header,
+                                    object_size=object_size)
+                return 206, {'Content-Range': 'bytes %d-%d/%d' % (first, last, size),
+                             'Content-Length': str(last - first + 1), 'Accept-Ranges': 'bytes'}, chunks
+    return 200, {}, download_decrypt(s3, key, bucket_name=bucket_name)
+
+
+def download_response(status, headers, chunks):
+    response = StreamingHttpResponse(chunks, status=status, content_type='application/octet-stream')
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+def download_view(request, key):
+    # Streams the decrypted object: each chunk is decrypted as it arrives from S3 and sent on,
+    # so memory stays flat and the first byte goes out after the first chunk.
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        return download_response(*open_download(key, request.META.get('HTTP_RANGE')))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in NOT_FOUND_CODES:
+            raise
+        raise Http404(key)
+
+
+async def iter_chunks_async(chunks):
+    # pulls each chunk (an S3 read plus its decryption) on a worker thread
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        yield chunk
+
+
+# async views need Django 3.1 and async iterators in StreamingHttpResponse need 4.2;
+# older versions get download_view instead
+ASYNC_DOWNLOADS_SUPPORTED = django.VERSION >= (4, 2)
+
+
+async def download_view_async(request, key):
+    # download_view for ASGI deployments: the event loop never waits on S3 or on AES
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        status, headers, chunks = await sync_to_async(open_download, thread_sensitive=False)(
+            key, request.META.get('HTTP_RANGE'))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in NOT_FOUND_CODES:
+            raise
+        raise Http404(key)
+    return download_response(status, headers, iter_chunks_async(chunks))
+
+
 def get_from_datastore(key):
     data = load_data(key=key)
     raw_data = json.loads(data)
@@ -63,14 +229,10 @@ def get_from_datastore(key):
 
 
 def save_data(bucket_name='zappa-encode', key='key', data='boom!'):
-    now = datetime.now()
-    enc = Encryptor(input_filename='tests.py', output_filename='tests.py.encrypted')
-    enc.do_encryption()
-    with open(file='tests.py.encrypted', mode='rb') as file:
-        formatted_data = file.read()
     s3 = S3Utils()
     s3.set_default_bucket(bucket_name=bucket_name)
-    s3.create_object(key=key, content=formatted_data, bucket_name=bucket_name)
+    encrypt_upload(s3, key=key, source=data, bucket_name=bucket_name)
+    decrypted_cache.invalidate(s3, key=key, bucket_name=bucket_name)
 
 
 def load_data(bucket_name='zappa-encode', key='key'):
@@ -80,6 +242,16 @@ def load_data(bucket_name='zappa-encode', key='key'):
     return data
 
 
+decrypted_cache = ObjectCache(decode=lambda body: bytes(decrypt_bytes(body)))
+
+
+def load_decrypted_data(bucket_name='zappa-encode', key='key'):
+    # hot keys are served from memory, and revalidated with a conditional GET once stale
+    s3 = S3Utils()
+    s3.set_default_bucket(bucket_name=bucket_name)
+    return decrypted_cache.get(s3, key=key, bucket_name=bucket_name)
+
+
 def do_encode_test():
     bucket_name = 'zappa-encode'
     data = {
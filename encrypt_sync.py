@@ -0,0 +1,170 @@
+"""
+Encrypts a local directory tree into S3, skipping files that haven't changed.
+
+A manifest of size, mtime and sha256 per file is kept next to the tree and mirrored, encrypted,
+to <prefix>.manifest.json in the bucket. A file is re-hashed only when its size or mtime moved,
+and re-uploaded only when its hash changed. Hashing, encryption and upload run in a process
+pool, one file per worker, so a rerun over a mostly unchanged tree only stats files.
+
+    python encrypt_sync.py ~/backups nightly/ --bucket zappa-encode
+    python encrypt_sync.py ~/backups nightly/ --workers 16 --delete
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from botocore.exceptions import ClientError
+
+from Enkrypt import SegmentHeader, SegmentedEncryptor, decrypt_bytes, encrypt_upload, run_segment_jobs
+from s3_wrapper import S3Utils, reset_connections
+
+MANIFEST_NAME = '.encrypt_sync_manifest.json'
+MANIFEST_SAVE_EVERY = 1000  # files synced between manifest checkpoints, so a crash loses little
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_in:
+        while data := file_in.read(HASH_CHUNK_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def sync_file(path, key, bucket_name, known_digest):
+    # runs in a worker process; returns (sha256, uploaded, error), with error set and sha256
+    # None when the file couldn't be read or uploaded, so one bad file doesn't stop the sync
+    try:
+        digest = file_digest(path)
+        if digest == known_digest:
+            return digest, False, None
+        with open(path, 'rb') as source:
+            encrypt_upload(S3Utils(), key, source, bucket_name=bucket_name,
+                           encryptor_class=SegmentedEncryptor, workers=1)
+    except Exception as e:
+        return None, False, '%s: %s' % (type(e).__name__, e)
+    return digest, True, None
+
+
+def scan_tree(root, skip=()):
+    # yields (relative posix path, absolute path, size, mtime_ns) for every regular file
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if path in skip or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            yield os.path.relpath(path, root).replace(os.sep, '/'), path, stat.st_size, stat.st_mtime_ns
+
+
+def manifest_key(prefix):
+    return prefix.rstrip('/') + '.manifest.json'
+
+
+def load_manifest(manifest_path, s3, prefix, bucket_name):
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file_in:
+            return json.load(file_in)
+    try:
+        data = s3.get_object(manifest_key(prefix), bucket_name=bucket_name)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+        return {}
+    # manifests written before they were encrypted are plain JSON
+    if data[:len(SegmentHeader.MAGIC)] == SegmentHeader.MAGIC:
+        data = decrypt_bytes(data)
+    return json.loads(data)
+
+
+def save_manifest(manifest, manifest_path):
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as file_out:
+        json.dump(manifest, file_out, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def upload_manifest(manifest, s3, prefix, bucket_name):
+    # the manifest lists paths, sizes and hashes, so it is stored encrypted like the files
+    encrypt_upload(s3, manifest_key(prefix), json.dumps(manifest, sort_keys=True).encode(),
+                   bucket_name=bucket_name, encryptor_class=SegmentedEncryptor)
+
+
+def sync_tree(root, prefix, bucket_name=None, manifest_path=None, workers=None, delete=False, s3=None,
+              on_failure=None):
+    # on_failure(relative_path, error) is called for every file or key that couldn't be synced;
+    # failed files keep their previous manifest entry and are retried on the next run
+    root = os.path.abspath(root)
+    manifest_path = manifest_path or os.path.join(root, MANIFEST_NAME)
+    s3 = s3 or S3Utils()
+    manifest = load_manifest(manifest_path, s3, prefix, bucket_name)
+    stats = {'files': 0, 'unchanged': 0, 'rehashed': 0, 'uploaded': 0, 'deleted': 0, 'failed': 0,
+             'bytes_uploaded': 0}
+    seen = set()
+    changed = []
+    for relative_path, path, size, mtime_ns in scan_tree(root, skip={manifest_path, manifest_path + '.tmp'}):
+        stats['files'] += 1
+        seen.add(relative_path)
+        entry = manifest.get(relative_path)
+        if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+            stats['unchanged'] += 1
+            continue
+        changed.append((relative_path, path, size, mtime_ns))
+
+    jobs = ((sync_file, path, prefix + relative_path, bucket_name, (manifest.get(relative_path) or {}).get('sha256'))
+            for relative_path, path, size, mtime_ns in changed)
+    reset_connections()  # clients must not be inherited by forked workers
+    results = run_segment_jobs(jobs, workers, use_processes=True)
+    for done, ((relative_path, path, size, mtime_ns), (digest, uploaded, error)) in enumerate(zip(changed, results), 1):
+        if error:
+            stats['failed'] += 1
+            if on_failure:
+                on_failure(relative_path, error)
+        else:
+            manifest[relative_path] = {'size': size, 'mtime_ns': mtime_ns, 'sha256': digest}
+            stats['uploaded' if uploaded else 'rehashed'] += 1
+            stats['bytes_uploaded'] += size if uploaded else 0
+        if done % MANIFEST_SAVE_EVERY == 0:
+            save_manifest(manifest, manifest_path)
+
+    # without --delete the objects stay in S3, so their entries stay in the manifest too
+    removed = [relative_path for relative_path in manifest if relative_path not in seen]
+    if delete and removed:
+        errors = s3.delete_many((prefix + relative_path for relative_path in removed), bucket_name)
+        failed = {error['Key'][len(prefix):]: '%s: %s' % (error.get('Code'), error.get('Message'))
+                  for error in errors}
+        for relative_path in removed:
+            if relative_path in failed:
+                stats['failed'] += 1
+                if on_failure:
+                    on_failure(relative_path, failed[relative_path])
+            else:
+                del manifest[relative_path]
+        stats['deleted'] = len(removed) - len(failed)
+
+    save_manifest(manifest, manifest_path)
+    upload_manifest(manifest, s3, prefix, bucket_name)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help='local directory to back up')
+    parser.add_argument('prefix', help='S3 key prefix for the encrypted objects, e.g. nightly/')
+    parser.add_argument('--bucket', help='bucket name (defaults to S3_BUCKET_NAME)')
+    parser.add_argument('--manifest', help='local manifest path (defaults to %s in root)' % MANIFEST_NAME)
+    parser.add_argument('--workers', type=int, help='worker processes (defaults to the number of cores)')
+    parser.add_argument('--delete', action='store_true', help='delete objects whose local file is gone')
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    stats = sync_tree(args.root, args.prefix, args.bucket, args.manifest, args.workers, args.delete,
+                      on_failure=lambda path, error: print('%s\t%s' % (path, error), file=sys.stderr))
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Timing hooks for the crypto stages and S3 calls.
+
+Code under measurement wraps a stage in ``span('encrypt.body')``; every finished span becomes
+an Event (stage, duration, bytes, error) handed to the registered hooks and to the event list
+of the current request, if one is being collected. With no hooks and no collection active,
+span() returns a shared no-op object, so instrumentation costs one function call. Generators
+are timed with span_iter(), which only counts the time spent producing each chunk.
+
+    add_hook(StructuredLogExporter())          # JSON lines for CloudWatch Logs
+    aggregator = InMemoryAggregator()
+    add_hook(aggregator)                       # per-stage totals, e.g. in tests
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+
+_hooks = []
+_request_events = contextvars.ContextVar('instrumentation_request_events', default=None)
+
+
+class Event(object):
+    __slots__ = ('stage', 'duration', 'nbytes', 'error', 'attrs')
+
+    def __init__(self, stage, duration, nbytes=None, error=None, attrs=None):
+        self.stage = stage
+        self.duration = duration
+        self.nbytes = nbytes
+        self.error = error
+        self.attrs = attrs or {}
+
+    def as_dict(self):
+        return {'stage': self.stage, 'duration_ms': round(self.duration * 1000, 3), 'bytes': self.nbytes,
+                'error': self.error, **self.attrs}
+
+
+def add_hook(hook):
+    # hook is any callable taking an Event
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def enabled():
+    return bool(_hooks) or _request_events.get() is not None
+
+
+def emit(event):
+    for hook in tuple(_hooks):
+        hook(event)
+    events = _request_events.get()
+    if events is not None:
+        events.append(event)
+
+
+class Span(object):
+    __slots__ = ('stage', 'attrs', 'nbytes', 'start')
+
+    def __init__(self, stage, attrs):
+        self.stage = stage
+        self.attrs = attrs
+        self.nbytes = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        error = '%s: %s' % (exc_type.__name__, exc) if exc_type else None
+        emit(Event(self.stage, time.perf_counter() - self.start, self.nbytes, error, self.attrs))
+        return False
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    nbytes = property(lambda self: None, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, **attrs):
+    return Span(stage, attrs) if enabled() else NULL_SPAN
+
+
+def span_iter(stage, iterable, **attrs):
+    # For stages that run as a generator: times only the work of producing each chunk, not what
+    # the consumer does between chunks, and counts the bytes yielded. One event when it ends.
+    if not enabled():
+        return iterable
+    return _iter_timed(stage, iter(iterable), attrs)
+
+
+def _iter_timed(stage, iterator, attrs):
+    duration, nbytes, error = 0.0, 0, None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                duration += time.perf_counter() - start
+            nbytes += len(chunk)
+            yield chunk
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        emit(Event(stage, duration, nbytes, error, attrs))
+
+
+class collect_events(object):
+    # collects the events of the enclosed block (e.g. one HTTP request) into `events`;
+    # work handed to thread pools inside the block runs outside this context and isn't included
+    def __enter__(self):
+        self.events = []
+        self._token = _request_events.set(self.events)
+        return self.events
+
+    def __exit__(self, exc_type, exc, traceback):
+        _request_events.reset(self._token)
+        return False
+
+
+def summarize(events):
+    # {stage: {'count', 'total_s', 'min_s', 'max_s', 'bytes', 'errors'}}
+    stats = {}
+    for event in events:
+        row = stats.setdefault(event.stage, {'count': 0, 'total_s': 0.0, 'min_s': None, 'max_s': 0.0,
+                                             'bytes': 0, 'errors': 0})
+        row['count'] += 1
+        row['total_s'] += event.duration
+        row['min_s'] = event.duration if row['min_s'] is None else min(row['min_s'], event.duration)
+        row['max_s'] = max(row['max_s'], event.duration)
+        row['bytes'] += event.nbytes or 0
+        row['errors'] += 1 if event.error else 0
+    return stats
+
+
+class StructuredLogExporter(object):
+    # One JSON object per event on a single line, which CloudWatch Logs Insights can query
+    # directly (e.g. `stats avg(duration_ms) by stage`).
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('instrumentation')
+        self.level = level
+
+    def __call__(self, event):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps({'metric': 'timing', **event.as_dict()}, default=str))
+
+
+class InMemoryAggregator(object):
+    # keeps every event and per-stage totals; meant for tests and local profiling
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def stats(self):
+        with self._lock:
+            return summarize(self.events)
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+
+
+def _before_call(context=None, **kwargs):
+    if context is not None and enabled():
+        context['instrumentation_start'] = time.perf_counter()
+
+
+def _after_call(context=None, model=None, parsed=None, params=None, exception=None, **kwargs):
+    start = context.get('instrumentation_start') if context is not None else None
+    if start is None:
+        return
+    nbytes = None
+    if parsed and isinstance(parsed.get('ContentLength'), int):
+        nbytes = parsed['ContentLength']
+    error = None
+    if exception is not None:
+        error = '%s: %s' % (type(exception).__name__, exception)
+    elif parsed and 'Error' in parsed:
+        error = parsed['Error'].get('Code')
+    emit(Event('s3.%s' % model.name, time.perf_counter() - start, nbytes, error))
+
+
+def instrument_boto_client(client):
+    # times every API call the client makes (one event per request, multipart parts included)
+    events = client.meta.events
+    events.register('before-call.s3', _before_call, unique_id='instrumentation-before-call')
+    events.register('after-call.s3', _after_call, unique_id='instrumentation-after-call')
+    events.register('after-call-error.s3', _after_call, unique_id='instrumentation-after-call-error')
@@ -1 +1,4 @@
 from .utils import S3Utils
+from .async_utils import AsyncS3Utils
+from .connection import add_client_hook, get_connection, reset_connections
+from .transfer import TransferProgress, make_transfer_config
@@ -0,0 +1,130 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Iterable, Tuple
+
+from .utils import S3Utils
+
+MAX_CONCURRENCY = 32  # keep below the client's connection pool size (connection.MAX_POOL_CONNECTIONS)
+
+
+class AsyncS3Utils(object):
+    # Awaitable counterpart of S3Utils for ASGI deployments. Each call runs the blocking boto3
+    # request on a private thread pool over the shared client, so the event loop never blocks,
+    # and the *_many helpers keep up to `concurrency` requests in flight.
+
+    def __init__(self, s3: S3Utils = None, max_concurrency: int = MAX_CONCURRENCY, **kwargs):
+        self.s3 = s3 or S3Utils(**kwargs)
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='async-s3')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def get_bucket_name(self, bucket_name):
+        return self.s3.get_bucket_name(bucket_name)
+
+    def set_default_bucket(self, bucket_name: str):
+        self.s3.set_default_bucket(bucket_name)
+
+    async def move_object(self, old_key: str, new_key: str, bucket_name: str = None):
+        return await self._run(self.s3.move_object, old_key, new_key, bucket_name)
+
+    async def copy_object(self, new_obj_key: str, src_obj_key: str, bucket_name: str = None, **kwargs) -> dict:
+        return await self._run(self.s3.copy_object, new_obj_key, src_obj_key, bucket_name, **kwargs)
+
+    async def copy_many(self, pairs, bucket_name: str = None, **kwargs) -> list:
+        return await self._run(self.s3.copy_many, pairs, bucket_name, **kwargs)
+
+    async def move_many(self, pairs, bucket_name: str = None, **kwargs) -> list:
+        return await self._run(self.s3.move_many, pairs, bucket_name, **kwargs)
+
+    async def create_object(self, key: str, content: Any, bucket_name: str = None):
+        return await self._run(self.s3.create_object, key, content, bucket_name)
+
+    async def upload_file(self, key: str, file_path: str, bucket_name: str = None, **kwargs):
+        return await self._run(self.s3.upload_file, key, file_path, bucket_name, **kwargs)
+
+    async def upload_stream(self, key: str, source, bucket_name: str = None, **kwargs):
+        return await self._run(self.s3.upload_stream, key, source, bucket_name, **kwargs)
+
+    async def delete_object(self, key: str, bucket_name: str = None) -> bool:
+        return await self._run(self.s3.delete_object, key, bucket_name)
+
+    async def delete_objects(self, keys: list, bucket_name: str = None):
+        return await self._run(self.s3.delete_objects, keys, bucket_name)
+
+    async def delete_many(self, keys: Iterable[str], bucket_name: str = None) -> list:
+        return await self._run(self.s3.delete_many, keys, bucket_name)
+
+    async def delete_prefix(self, prefix: str, bucket_name: str = None) -> list:
+        return await self._run(self.s3.delete_prefix, prefix, bucket_name)
+
+    async def find_files_with_prefix(self, prefix: str, bucket_name: str = None) -> list:
+        # the sync version returns a lazy collection that pages on iteration, so list it here
+        return await self._run(lambda: list(self.s3.find_files_with_prefix(prefix, bucket_name)))
+
+    async def generate_presigned_url(self, key: str, expiration: int, bucket_name: str = None, **kwargs) -> str:
+        return await self._run(self.s3.generate_presigned_url, key, expiration, bucket_name, **kwargs)
+
+    async def generate_presigned_urls(self, keys: Iterable[str], expiration: int, bucket_name: str = None,
+                                      **kwargs) -> dict:
+        return await self._run(self.s3.generate_presigned_urls, list(keys), expiration, bucket_name, **kwargs)
+
+    async def download_file(self, key: str, file_path: str, bucket_name: str = None, **kwargs):
+        return await self._run(self.s3.download_file, key, file_path, bucket_name, **kwargs)
+
+    async def download_write_to_file(self, key: str, file_io=None, bucket_name: str = None, **kwargs):
+        return await self._run(self.s3.download_write_to_file, key, file_io, bucket_name, **kwargs)
+
+    async def get_object(self, key: str, bucket_name: str = None) -> bytes:
+        return await self._run(self.s3.get_object, key, bucket_name)
+
+    async def get_object_if_changed(self, key: str, etag: str = None, bucket_name: str = None) -> tuple:
+        return await self._run(self.s3.get_object_if_changed, key, etag, bucket_name)
+
+    async def get_object_range(self, key: str, start: int, end: int = None, bucket_name: str = None) -> tuple:
+        return await self._run(self.s3.get_object_range, key, start, end, bucket_name)
+
+    async def head_object(self, key: str, bucket_name: str = None, use_cache: bool = True):
+        return await self._run(self.s3.head_object, key, bucket_name, use_cache)
+
+    async def file_exists(self, key: str, bucket_name: str = None, use_cache: bool = True) -> bool:
+        return await self._run(self.s3.file_exists, key, bucket_name, use_cache)
+
+    async def exists_many(self, keys: Iterable[str], bucket_name: str = None, use_cache: bool = True) -> dict:
+        return await self._run(self.s3.exists_many, list(keys), bucket_name, use_cache)
+
+    async def _bounded(self, calls, concurrency=None, return_exceptions=False):
+        semaphore = asyncio.Semaphore(concurrency or self.max_concurrency)
+
+        async def bounded(call):
+            async with semaphore:
+                return await call
+
+        return await asyncio.gather(*(bounded(call) for call in calls), return_exceptions=return_exceptions)
+
+    async def get_many(self, keys: Iterable[str], bucket_name: str = None, concurrency: int = None,
+                       return_exceptions: bool = False) -> list:
+        # object bodies in the order of keys
+        return await self._bounded((self.get_object(key, bucket_name) for key in keys),
+                                   concurrency, return_exceptions)
+
+    async def put_many(self, items: Iterable[Tuple[str, Any]], bucket_name: str = None, concurrency: int = None,
+                       return_exceptions: bool = False) -> list:
+        # items are (key, content) pairs, or a dict of key -> content
+        if isinstance(items, dict):
+            items = items.items()
+        return await self._bounded((self.create_object(key, content, bucket_name) for key, content in items),
+                                   concurrency, return_exceptions)
+
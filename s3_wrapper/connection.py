@@ -0,0 +1,84 @@
+import os
+import threading
+
+from .metadata import MetadataCache
+from .presign import PresignedUrlCache
+
+MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50))
+
+_connections = {}
+_connections_lock = threading.Lock()
+_client_hooks = []
+
+
+class S3Connection(object):
+    # One boto3 session and S3 client per (profile, region, endpoint). Clients are thread-safe
+    # and keep their HTTP connections open, so every S3Utils with the same settings shares one
+    # connection pool instead of paying session setup, credential lookup and a TLS handshake.
+
+    def __init__(self, LOCAL_TEST=False, profile_name=None, region_name=None, endpoint_url=None,
+                 max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=False):
+        if LOCAL_TEST:
+            import localstack_client.session as boto3
+        else:
+            import boto3
+        from botocore.config import Config
+
+        session_kwargs = {'profile_name': profile_name}
+        if region_name:
+            session_kwargs['region_name'] = region_name
+        self._session = boto3.Session(**session_kwargs)
+        config_kwargs = {'max_pool_connections': max_pool_connections}
+        if tcp_keepalive:
+            config_kwargs['tcp_keepalive'] = True
+        self._client_kwargs = {'config': Config(**config_kwargs)}
+        if endpoint_url:
+            self._client_kwargs['endpoint_url'] = endpoint_url
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.client = self._session.client('s3', **self._client_kwargs)
+        for hook in tuple(_client_hooks):
+            hook(self.client)
+        self.metadata = MetadataCache()
+        self.presigned_urls = PresignedUrlCache()
+
+    @property
+    def resource(self):
+        # resources aren't thread-safe, so each thread gets its own, wired to the shared client
+        resource = getattr(self._local, 'resource', None)
+        if resource is None:
+            with self._lock:
+                resource = self._session.resource('s3', **self._client_kwargs)
+            resource.meta.client = self.client
+            self._local.resource = resource
+        return resource
+
+
+def get_connection(LOCAL_TEST=False, profile_name=None, region_name=None, endpoint_url=None,
+                   max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=False) -> S3Connection:
+    cache_key = (LOCAL_TEST, profile_name, region_name, endpoint_url, max_pool_connections, tcp_keepalive)
+    with _connections_lock:
+        connection = _connections.get(cache_key)
+        if connection is None:
+            connection = S3Connection(LOCAL_TEST, profile_name, region_name, endpoint_url,
+                                      max_pool_connections, tcp_keepalive)
+            _connections[cache_key] = connection
+        return connection
+
+
+def add_client_hook(hook):
+    # hook(client) is called with every S3 client, e.g. to register botocore event handlers;
+    # clients that already exist get it right away
+    with _connections_lock:
+        if hook in _client_hooks:
+            return
+        _client_hooks.append(hook)
+        connections = tuple(_connections.values())
+    for connection in connections:
+        hook(connection.client)
+
+
+def reset_connections():
+    # drops the shared clients, e.g. after credentials were rotated or in a forked worker
+    with _connections_lock:
+        _connections.clear()
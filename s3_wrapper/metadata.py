@@ -0,0 +1,53 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+METADATA_TTL = float(os.getenv('S3_METADATA_TTL', 30))
+METADATA_MAX_ITEMS = int(os.getenv('S3_METADATA_MAX_ITEMS', 10000))
+
+_MISSING = object()
+
+
+class MetadataCache(object):
+    # Small TTL cache of object metadata ({'Size', 'ETag', 'LastModified'}) keyed by
+    # (bucket, key). None is cached too, meaning "known not to exist". S3Utils writes and
+    # deletes update it, so only changes made by other processes can be up to ttl old. Entries
+    # written after a put have 'LastModified': None, since S3 does not return it there.
+
+    def __init__(self, ttl=METADATA_TTL, max_items=METADATA_MAX_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name, key, default=_MISSING):
+        # the cached metadata or None, or `default` when nothing fresh is cached
+        with self._lock:
+            entry = self._entries.get((bucket_name, key))
+            if entry is None:
+                return default
+            expires, metadata = entry
+            if expires <= time.monotonic():
+                del self._entries[(bucket_name, key)]
+                return default
+            self._entries.move_to_end((bucket_name, key))
+            return metadata
+
+    def set(self, bucket_name, key, metadata):
+        with self._lock:
+            self._entries[(bucket_name, key)] = (time.monotonic() + self.ttl, metadata)
+            self._entries.move_to_end((bucket_name, key))
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def forget(self, bucket_name, key):
+        with self._lock:
+            self._entries.pop((bucket_name, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, bucket_and_key):
+        return self.get(*bucket_and_key) is not _MISSING
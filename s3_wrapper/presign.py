@@ -0,0 +1,45 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PRESIGN_MARGIN = float(os.getenv('S3_PRESIGN_MARGIN', 300))  # seconds of validity a reused URL must have left
+PRESIGN_MAX_ITEMS = int(os.getenv('S3_PRESIGN_MAX_ITEMS', 10000))
+
+
+class PresignedUrlCache(object):
+    # Issued presigned URLs keyed by (bucket, key, method). A URL is handed out again while it
+    # has more than `margin` seconds left, and only to callers asking for the same expiration,
+    # so nobody gets a URL that lives longer than they asked for.
+
+    def __init__(self, margin=PRESIGN_MARGIN, max_items=PRESIGN_MAX_ITEMS):
+        self.margin = margin
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name, key, method, expiration):
+        with self._lock:
+            entry = self._entries.get((bucket_name, key, method))
+            if entry is None:
+                return None
+            entry_expiration, expires, url = entry
+            if entry_expiration != expiration or expires - time.time() <= self.margin:
+                return None
+            self._entries.move_to_end((bucket_name, key, method))
+            return url
+
+    def set(self, bucket_name, key, method, expiration, url, issued):
+        # issued is the time.time() at signing
+        if expiration <= self.margin:
+            return
+        with self._lock:
+            self._entries[(bucket_name, key, method)] = (expiration, issued + expiration, url)
+            self._entries.move_to_end((bucket_name, key, method))
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        # e.g. after credentials were rotated, which invalidates every issued URL
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,88 @@
+import copy
+import threading
+import time
+
+MB = 1024 * 1024
+
+
+def make_transfer_config(config=None, **kwargs):
+    # Builds a boto3 TransferConfig from another TransferConfig and/or keyword overrides:
+    # multipart_threshold, multipart_chunksize, max_concurrency, use_threads, ...
+    if config is None and not kwargs:
+        return None
+    from boto3.s3.transfer import TransferConfig
+
+    if isinstance(config, dict):
+        kwargs = {**config, **kwargs}
+        config = None
+    if config is None:
+        return TransferConfig(**kwargs)
+    if not kwargs:
+        return config
+    # a copy keeps every setting of the base, including ones added by newer boto3 versions
+    config = copy.copy(config)
+    for name, value in kwargs.items():
+        if not hasattr(config, name):
+            raise TypeError('Unknown TransferConfig setting %r' % name)
+        setattr(config, name, value)
+    return config
+
+
+class TransferProgress(object):
+    # Pass as `progress=` to upload_file/download_file/download_write_to_file. boto3 calls it
+    # from its worker threads with the number of bytes moved since the last call; it keeps the
+    # running total and timestamps so throughput, and the time each part_size worth of bytes
+    # took, can be read during or after the transfer. A part that is much slower than the
+    # others usually means the transfer was throttled.
+
+    def __init__(self, total_bytes: int = None, part_size: int = 8 * MB, on_progress=None):
+        self.total_bytes = total_bytes
+        self.part_size = part_size
+        self.on_progress = on_progress
+        self.bytes_transferred = 0
+        self.started = None
+        self.finished = None
+        self.part_timings = []  # seconds taken by each part_size bytes, in completion order
+        self._part_started = None
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount: int):
+        now = time.perf_counter()
+        with self._lock:
+            if self.started is None:
+                self.started = self._part_started = now
+            previous = self.bytes_transferred
+            self.bytes_transferred += bytes_amount
+            self.finished = now
+            for _ in range(self.bytes_transferred // self.part_size - previous // self.part_size):
+                self.part_timings.append(now - self._part_started)
+                self._part_started = now
+        if self.on_progress:
+            self.on_progress(self)
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes_transferred / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def fraction_done(self) -> float:
+        return self.bytes_transferred / self.total_bytes if self.total_bytes else 0.0
+
+    def summary(self) -> dict:
+        with self._lock:
+            part_rates = [self.part_size / seconds for seconds in self.part_timings if seconds]
+            return {
+                'bytes': self.bytes_transferred,
+                'seconds': self.elapsed,
+                'bytes_per_second': self.bytes_per_second,
+                'part_size': self.part_size,
+                'part_seconds': list(self.part_timings),
+                'slowest_part_bytes_per_second': min(part_rates) if part_rates else None,
+                'fastest_part_bytes_per_second': max(part_rates) if part_rates else None,
+            }
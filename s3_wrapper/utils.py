@@ -1,108 +1,518 @@
 import os
-from io import BytesIO
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from urllib.parse import urlencode
 
-from typing import Any
+from typing import Any, Iterable, Iterator, Mapping, Tuple, Union
+
+from botocore.exceptions import ClientError
+
+from .connection import MAX_POOL_CONNECTIONS, get_connection
+from .transfer import make_transfer_config
+
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 needs every part but the last to be at least 5 MB
+MULTIPART_PARTS_IN_FLIGHT = 4
+DELETE_BATCH_SIZE = 1000  # the most keys S3 accepts in one DeleteObjects call
+DELETE_BATCHES_IN_FLIGHT = 8
+HEAD_CONCURRENCY = 32
+EXISTS_LIST_MIN_KEYS = 20  # below this, concurrent HEADs beat a prefix scan
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+COPY_MULTIPART_THRESHOLD = 128 * 1024 * 1024  # larger objects are copied as parallel part ranges
+COPY_PART_SIZE = 128 * 1024 * 1024
+COPY_PARTS_IN_FLIGHT = 8
+COPY_MAX_PARTS = 10000
+COPY_CONCURRENCY = 32  # objects copied at once by copy_many/move_many
+# source HEAD fields a copy carries over: CopyObject keeps metadata and content headers by
+# itself but not the storage class or encryption settings, and a multipart copy keeps nothing
+COPY_STORAGE_FIELDS = ('StorageClass', 'ServerSideEncryption', 'SSEKMSKeyId', 'BucketKeyEnabled')
+COPY_HEAD_FIELDS = ('Metadata', 'ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage',
+                    'CacheControl', 'Expires', 'WebsiteRedirectLocation') + COPY_STORAGE_FIELDS
+
+
+def iter_batches(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_args(head: dict, fields) -> dict:
+    return {field: head[field] for field in fields if head.get(field) is not None}
+
+
+def iter_parts(source, part_size: int):
+    # re-chunks a readable or an iterable of bytes into part_size pieces (the last may be shorter)
+    if hasattr(source, 'read'):
+        while data := source.read(part_size):
+            buffer = bytearray(data)
+            while len(buffer) < part_size and (data := source.read(part_size - len(buffer))):
+                buffer += data
+            yield bytes(buffer)
+        return
+    buffer = bytearray()
+    for data in source:
+        buffer += data
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
 
 
 class S3Utils(object):
 
-    def __init__(self, LOCAL_TEST=False):
-        if LOCAL_TEST:
-            import localstack_client.session as boto3
-        else:
-            import boto3
-
-        aws_profile = os.getenv('AWS_PROFILE_NAME', None)
-        session = boto3.Session(profile_name=aws_profile)
-        self._s3 = session.resource('s3')
-        self._s3_client = self._s3.meta.client
-        if os.getenv('S3_BUCKET_NAME'):
-            self._default_bucket = self._s3.Bucket(os.getenv('S3_BUCKET_NAME'))
+    def __init__(self, LOCAL_TEST=False, profile_name: str = None, region_name: str = None,
+                 endpoint_url: str = None, max_pool_connections: int = MAX_POOL_CONNECTIONS,
+                 tcp_keepalive: bool = False, transfer_config=None):
+        # the client behind this is shared process-wide (see connection.get_connection),
+        # so constructing an S3Utils per request is cheap
+        self._connection = get_connection(
+            LOCAL_TEST=LOCAL_TEST,
+            profile_name=profile_name or os.getenv('AWS_PROFILE_NAME', None),
+            region_name=region_name or os.getenv('AWS_REGION', None),
+            endpoint_url=endpoint_url or os.getenv('S3_ENDPOINT_URL', None),
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=tcp_keepalive)
+        self._s3_client = self._connection.client
+        self.metadata = self._connection.metadata
+        self.presigned_urls = self._connection.presigned_urls
         self._default_bucket_name = os.getenv('S3_BUCKET_NAME')
+        # boto3 TransferConfig (or dict of its arguments) for upload_file/download_file
+        self.transfer_config = make_transfer_config(transfer_config)
+
+    @property
+    def _s3(self):
+        return self._connection.resource
+
+    def _transfer_args(self, transfer_config=None, progress=None) -> dict:
+        # a per-call dict overrides single settings of the instance config, a TransferConfig replaces it
+        if isinstance(transfer_config, dict):
+            config = make_transfer_config(self.transfer_config, **transfer_config)
+        else:
+            config = transfer_config or self.transfer_config
+        kwargs = {}
+        if config is not None:
+            kwargs['Config'] = config
+        if progress is not None:
+            kwargs['Callback'] = progress
+        return kwargs
 
     def get_bucket_name(self, bucket_name):
         return bucket_name if bucket_name is not None else self._default_bucket_name
 
     def get_bucket(self, bucket_name=None):
-        if bucket_name:
-            bucket = self._s3.Bucket(bucket_name)
-        else:
-            bucket = self._default_bucket
-        return bucket
+        return self._s3.Bucket(self.get_bucket_name(bucket_name))
 
     def set_default_bucket(self, bucket_name: str):
         assert bucket_name and isinstance(bucket_name, str)
-        self._default_bucket = self._s3.Bucket(bucket_name)
         self._default_bucket_name = bucket_name
 
     def move_object(self, old_key: str, new_key: str, bucket_name: str = None) -> bool:
+        # the source is deleted only once the copy is confirmed to exist at its full size
+        bucket_name = self.get_bucket_name(bucket_name)
+        self.copy_object(new_key, old_key, bucket_name, verify=True)
+        self._s3_client.delete_object(Bucket=bucket_name, Key=old_key)
+        self.metadata.set(bucket_name, old_key, None)
+        return True
+
+    def copy_object(self, new_obj_key: str, src_obj_key: str, bucket_name: str = None, verify: bool = False,
+                    multipart_threshold: int = COPY_MULTIPART_THRESHOLD, part_size: int = COPY_PART_SIZE,
+                    parts_in_flight: int = COPY_PARTS_IN_FLIGHT) -> dict:
+        # Server-side copy. Objects above multipart_threshold (which also covers the 5 GB limit
+        # of a single CopyObject) are copied as UploadPartCopy ranges, parts_in_flight at a time.
+        # Every request is pinned to the source ETag, so an overwrite mid-copy fails the copy
+        # instead of mixing versions. With verify, the new object is HEADed and must match the
+        # source size, else ValueError. Returns the new object's metadata.
         bucket_name = self.get_bucket_name(bucket_name)
-        self._s3.Object(bucket_name, new_key).copy_from(
-            CopySource=f"{bucket_name}/{old_key}")
-        self._s3.Object(bucket_name, old_key).delete()
+        source = self._s3_client.head_object(Bucket=bucket_name, Key=src_obj_key)
+        size, etag = source['ContentLength'], source['ETag']
+        copy_source = {'Bucket': bucket_name, 'Key': src_obj_key}
+        self.metadata.forget(bucket_name, new_obj_key)
+        if size <= multipart_threshold:
+            response = self._s3_client.copy_object(Bucket=bucket_name, Key=new_obj_key, CopySource=copy_source,
+                                                   CopySourceIfMatch=etag, **copy_args(source, COPY_STORAGE_FIELDS))
+            result = response['CopyObjectResult']
+            new_etag, last_modified = result['ETag'], result['LastModified']
+        else:
+            # CompleteMultipartUpload does not report LastModified; head_object fetches it when asked
+            new_etag = self._copy_multipart(bucket_name, new_obj_key, copy_source, source, part_size, parts_in_flight)
+            last_modified = None
+        metadata = {'Size': size, 'ETag': new_etag, 'LastModified': last_modified}
+        if verify:
+            metadata = self.head_object(new_obj_key, bucket_name, use_cache=False)
+            if metadata is None or metadata['Size'] != size:
+                raise ValueError('Copy of %s to %s is incomplete' % (src_obj_key, new_obj_key))
+        self.metadata.set(bucket_name, new_obj_key, metadata)
+        return metadata
+
+    def _copy_multipart(self, bucket_name, key, copy_source, source, part_size, parts_in_flight):
+        size = source['ContentLength']
+        part_size = max(part_size, -(-size // COPY_MAX_PARTS))
+        create_args = copy_args(source, COPY_HEAD_FIELDS)
+        # CopyObject copies tags by default, a multipart upload starts without any; HEAD reports
+        # TagCount, so untagged sources cost no extra request
+        if source.get('TagCount'):
+            tags = self._s3_client.get_object_tagging(Bucket=copy_source['Bucket'], Key=copy_source['Key'])['TagSet']
+            create_args['Tagging'] = urlencode([(tag['Key'], tag['Value']) for tag in tags])
+        upload_id = self._s3_client.create_multipart_upload(Bucket=bucket_name, Key=key, **create_args)['UploadId']
+        try:
+            ranges = [(part_number, start, min(start + part_size, size) - 1)
+                      for part_number, start in enumerate(range(0, size, part_size), 1)]
+            with ThreadPoolExecutor(max_workers=parts_in_flight) as pool:
+                parts = list(pool.map(
+                    lambda part: self._copy_part(bucket_name, key, upload_id, copy_source, source['ETag'], *part),
+                    ranges))
+            response = self._s3_client.complete_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+            return response['ETag']
+        except BaseException:
+            self._s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def _copy_part(self, bucket_name, key, upload_id, copy_source, etag, part_number, start, end):
+        response = self._s3_client.upload_part_copy(
+            Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=part_number, CopySource=copy_source,
+            CopySourceRange=f'bytes={start}-{end}', CopySourceIfMatch=etag)
+        return {'ETag': response['CopyPartResult']['ETag'], 'PartNumber': part_number}
 
-    def copy_object(self, new_obj_key: str, src_obj_key: str, bucket_name: str = None):
+    def copy_many(self, pairs: Union[Mapping[str, str], Iterable[Tuple[str, str]]], bucket_name: str = None,
+                  concurrency: int = COPY_CONCURRENCY) -> list:
+        # Copies (source key, new key) pairs, or a {source: new key} dict, with up to
+        # `concurrency` copies in flight. Returns the pairs that failed as
+        # [{'Key': ..., 'NewKey': ..., 'Code': ..., 'Message': ...}]; an empty list means all copied.
+        return [error for _, error in self._iter_copies(pairs, self.get_bucket_name(bucket_name), concurrency)
+                if error]
+
+    def move_many(self, pairs: Union[Mapping[str, str], Iterable[Tuple[str, str]]], bucket_name: str = None,
+                  concurrency: int = COPY_CONCURRENCY, batches_in_flight: int = DELETE_BATCHES_IN_FLIGHT) -> list:
+        # copy_many, deleting the sources in 1000-key batches as their copies are confirmed
+        # (HEADed at full size); a source whose copy failed is never deleted. Returns copy and
+        # delete failures in the copy_many/delete_many format.
         bucket_name = self.get_bucket_name(bucket_name)
-        self._s3.Object(bucket_name, new_obj_key).copy_from(
-            CopySource=f'{bucket_name}/{src_obj_key}')
+        errors = []
+        confirmed = []
+        with ThreadPoolExecutor(max_workers=batches_in_flight) as pool:
+            pending = deque()
+            for source_key, error in self._iter_copies(pairs, bucket_name, concurrency, verify=True):
+                if error:
+                    errors.append(error)
+                    continue
+                confirmed.append(source_key)
+                if len(confirmed) == DELETE_BATCH_SIZE:
+                    pending.append(pool.submit(self._delete_batch, bucket_name, confirmed))
+                    confirmed = []
+                    if len(pending) >= batches_in_flight:
+                        errors.extend(pending.popleft().result())
+            if confirmed:
+                pending.append(pool.submit(self._delete_batch, bucket_name, confirmed))
+            for future in pending:
+                errors.extend(future.result())
+        return errors
+
+    def _iter_copies(self, pairs, bucket_name, concurrency, verify=False):
+        # yields (source key, error or None) in input order, keeping at most 2 * concurrency copies pending
+        if isinstance(pairs, Mapping):
+            pairs = pairs.items()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pending = deque()
+            for source_key, new_key in pairs:
+                future = pool.submit(self.copy_object, new_key, source_key, bucket_name, verify)
+                pending.append((source_key, new_key, future))
+                if len(pending) >= 2 * concurrency:
+                    yield self._copy_outcome(*pending.popleft())
+            while pending:
+                yield self._copy_outcome(*pending.popleft())
+
+    @staticmethod
+    def _copy_outcome(source_key, new_key, future):
+        try:
+            future.result()
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            return source_key, {'Key': source_key, 'NewKey': new_key, 'Code': error.get('Code'),
+                                'Message': error.get('Message')}
+        except ValueError as e:
+            return source_key, {'Key': source_key, 'NewKey': new_key, 'Code': 'IncompleteCopy', 'Message': str(e)}
+        return source_key, None
 
     def create_object(self, key: str, content: Any, bucket_name: str = None):
         bucket_name = self.get_bucket_name(bucket_name)
-        s3_object = self._s3.Object(bucket_name, key)
-        s3_object.put(Body=bytes(content, 'utf-8'))
+        body = content if isinstance(content, (bytes, bytearray)) else bytes(content, 'utf-8')
+        response = self._s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+        self.metadata.set(bucket_name, key, {'Size': len(body), 'ETag': response['ETag'], 'LastModified': None})
 
-    def upload_file(self, key: str, file_path: str, bucket_name: str = None):
-        bucket = self.get_bucket(bucket_name)
-        bucket.upload_file(file_path, key)
+    def upload_file(self, key: str, file_path: str, bucket_name: str = None, transfer_config=None, progress=None):
+        bucket_name = self.get_bucket_name(bucket_name)
+        self._s3_client.upload_file(file_path, bucket_name, key, **self._transfer_args(transfer_config, progress))
+        self.metadata.forget(bucket_name, key)
+
+    def upload_stream(self, key: str, source: Union[Iterable[bytes], Any], bucket_name: str = None,
+                      part_size: int = MULTIPART_PART_SIZE, parts_in_flight: int = MULTIPART_PARTS_IN_FLIGHT):
+        # Uploads a readable or an iterable of bytes chunks without knowing its size up front.
+        # Parts upload on a thread pool while the source keeps producing, and at most
+        # parts_in_flight parts are held in memory at once.
+        bucket_name = self.get_bucket_name(bucket_name)
+        self.metadata.forget(bucket_name, key)
+        parts = iter_parts(source, part_size)
+        first = next(parts, b'')
+        second = next(parts, None)
+        if second is None:
+            response = self._s3_client.put_object(Bucket=bucket_name, Key=key, Body=first)
+            self.metadata.set(bucket_name, key, {'Size': len(first), 'ETag': response['ETag'], 'LastModified': None})
+            return
+        upload_id = self._s3_client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+        try:
+            completed = []
+            with ThreadPoolExecutor(max_workers=parts_in_flight) as pool:
+                pending = deque()
+                for part_number, body in enumerate(chain([first, second], parts), 1):
+                    pending.append(pool.submit(self._upload_part, bucket_name, key, upload_id, part_number, body))
+                    if len(pending) >= parts_in_flight:
+                        completed.append(pending.popleft().result())
+                completed.extend(future.result() for future in pending)
+            self._s3_client.complete_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': completed})
+        except BaseException:
+            self._s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def _upload_part(self, bucket_name, key, upload_id, part_number, body):
+        response = self._s3_client.upload_part(
+            Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
 
     def delete_object(self, key: str, bucket_name: str = None) -> bool:
-        bucket = self.get_bucket(bucket_name)
-        bucket.delete_objects(
+        bucket_name = self.get_bucket_name(bucket_name)
+        self._s3_client.delete_objects(
+            Bucket=bucket_name,
             Delete={
                 'Objects': [{'Key': key}]
             },
         )
+        self.metadata.set(bucket_name, key, None)
         return True
 
     def delete_objects(self, keys: list, bucket_name: str = None) -> bool:
-        bucket = self.get_bucket(bucket_name)
-        bucket.delete_objects(
-            Delete={
-                'Objects': [{'Key': key} for key in keys]
-            },
-        )
+        return not self.delete_many(keys, bucket_name)
+
+    def delete_many(self, keys: Iterable[str], bucket_name: str = None,
+                    batches_in_flight: int = DELETE_BATCHES_IN_FLIGHT) -> list:
+        # Deletes any number of keys (a list or a generator such as iter_keys) in 1000-key
+        # batches sent concurrently. Returns the keys S3 failed to delete as
+        # [{'Key': ..., 'Code': ..., 'Message': ...}]; an empty list means everything went.
+        bucket_name = self.get_bucket_name(bucket_name)
+        errors = []
+        with ThreadPoolExecutor(max_workers=batches_in_flight) as pool:
+            pending = deque()
+            for batch in iter_batches(keys, DELETE_BATCH_SIZE):
+                pending.append(pool.submit(self._delete_batch, bucket_name, batch))
+                if len(pending) >= batches_in_flight:
+                    errors.extend(pending.popleft().result())
+            for future in pending:
+                errors.extend(future.result())
+        return errors
+
+    def _delete_batch(self, bucket_name, keys):
+        try:
+            response = self._s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True,
+                },
+            )
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            for key in keys:
+                self.metadata.forget(bucket_name, key)
+            return [{'Key': key, 'Code': error.get('Code'), 'Message': error.get('Message')} for key in keys]
+        errors = [{'Key': error['Key'], 'Code': error.get('Code'), 'Message': error.get('Message')}
+                  for error in response.get('Errors', [])]
+        failed = {error['Key'] for error in errors}
+        for key in keys:
+            if key in failed:
+                self.metadata.forget(bucket_name, key)
+            else:
+                self.metadata.set(bucket_name, key, None)
+        return errors
+
+    def delete_prefix(self, prefix: str, bucket_name: str = None) -> list:
+        return self.delete_many(self.iter_keys(prefix, bucket_name), bucket_name)
 
     def find_files_with_prefix(self, prefix: str, bucket_name: str = None) -> list:
         bucket = self.get_bucket(bucket_name)
         objects = bucket.objects.filter(Prefix=prefix)
         return objects
 
-    def generate_presigned_url(self, key: str, expiration: int, bucket_name: str = None) -> str:
+    def iter_key_pages(self, prefix: str, bucket_name: str = None, with_metadata: bool = False,
+                       page_size: int = 1000) -> Iterator[list]:
+        # one list per ListObjectsV2 page, fetched only when the previous page is consumed
         bucket_name = self.get_bucket_name(bucket_name)
-        url = self._s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': key, },
-            ExpiresIn=expiration
-        )
-        return url
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': page_size})
+        for page in pages:
+            contents = page.get('Contents', [])
+            if with_metadata:
+                yield [{'Key': item['Key'], 'Size': item['Size'], 'ETag': item['ETag'],
+                        'LastModified': item['LastModified']} for item in contents]
+            else:
+                yield [item['Key'] for item in contents]
+
+    def iter_keys(self, prefix: str, bucket_name: str = None, with_metadata: bool = False,
+                  page_size: int = 1000) -> Iterator:
+        # keys (or metadata dicts) under a prefix, streamed page by page
+        for page in self.iter_key_pages(prefix, bucket_name, with_metadata, page_size):
+            yield from page
+
+    def generate_presigned_url(self, key: str, expiration: int, bucket_name: str = None,
+                               method: str = 'get_object', use_cache: bool = False) -> str:
+        return self.generate_presigned_urls([key], expiration, bucket_name, method, use_cache)[key]
 
-    def download_file(self, key: str, file_path: str, bucket_name: str = None):
+    def generate_presigned_urls(self, keys: Iterable[str], expiration: int, bucket_name: str = None,
+                                method: str = 'get_object', use_cache: bool = True) -> dict:
+        # {key: url} in the order given. URLs issued earlier with the same expiration are reused
+        # while they have more than presigned_urls.margin seconds left, so re-rendering a page of
+        # links signs only the new ones.
         bucket_name = self.get_bucket_name(bucket_name)
-        self._s3_client.download_file(bucket_name, key, file_path)
+        urls = {}
+        for key in keys:
+            url = self.presigned_urls.get(bucket_name, key, method, expiration) if use_cache else None
+            if url is None:
+                issued = time.time()
+                url = self._s3_client.generate_presigned_url(
+                    method,
+                    Params={'Bucket': bucket_name, 'Key': key, },
+                    ExpiresIn=expiration
+                )
+                self.presigned_urls.set(bucket_name, key, method, expiration, url, issued)
+            urls[key] = url
+        return urls
 
-    def download_write_to_file(self, key: str, file_io=None, bucket_name: str = None):
+    def download_file(self, key: str, file_path: str, bucket_name: str = None, transfer_config=None, progress=None):
         bucket_name = self.get_bucket_name(bucket_name)
-        self._s3_client.download_fileobj(bucket_name, key, file_io)
+        self._s3_client.download_file(bucket_name, key, file_path, **self._transfer_args(transfer_config, progress))
 
-    def get_object(self,key):
-        file = BytesIO()
-        self.download_write_to_file(key=key, file_io=file)
-        return file.getvalue()
+    def download_write_to_file(self, key: str, file_io=None, bucket_name: str = None, transfer_config=None,
+                               progress=None):
+        bucket_name = self.get_bucket_name(bucket_name)
+        self._s3_client.download_fileobj(bucket_name, key, file_io, **self._transfer_args(transfer_config, progress))
+
+    def get_object(self, key: str, bucket_name: str = None) -> bytes:
+        # a single GET; download_fileobj would add a HEAD round trip before it
+        return self.get_object_stream(key, bucket_name=bucket_name).read()
+
+    def get_object_if_changed(self, key: str, etag: str = None, bucket_name: str = None) -> tuple:
+        # Conditional GET: returns (body, etag), or (None, etag) when the object still has the
+        # given etag, in which case S3 answers 304 and no body is transferred.
+        bucket_name = self.get_bucket_name(bucket_name)
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        try:
+            response = self._s3_client.get_object(Bucket=bucket_name, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304 or \
+                    e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return None, etag
+            raise
+        return response['Body'].read(), response['ETag']
+
+    def get_object_stream(self, key: str, bucket_name: str = None, start: int = None, end: int = None):
+        # the response body as a non-seekable botocore StreamingBody; read it in chunks with .read(n).
+        # start/end (inclusive) stream only that byte range
+        bucket_name = self.get_bucket_name(bucket_name)
+        kwargs = {}
+        if start is not None:
+            kwargs['Range'] = f'bytes={start}-{end}' if end is not None else f'bytes={start}-'
+        return self._s3_client.get_object(Bucket=bucket_name, Key=key, **kwargs)['Body']
 
-    def file_exists(self, key: str, bucket_name: str = None) -> bool:
+    def get_object_range(self, key: str, start: int, end: int = None, bucket_name: str = None) -> tuple:
+        # end is inclusive, as in the HTTP Range header; returns (data, size of the whole object)
         bucket_name = self.get_bucket_name(bucket_name)
+        byte_range = f'bytes={start}-{end}' if end is not None else f'bytes={start}-'
+        response = self._s3_client.get_object(Bucket=bucket_name, Key=key, Range=byte_range)
+        object_size = int(response['ContentRange'].rsplit('/', 1)[1])
+        return response['Body'].read(), object_size
+
+    def head_object(self, key: str, bucket_name: str = None, use_cache: bool = True):
+        # {'Size', 'ETag', 'LastModified'}, or None if there is no such object; throttling and
+        # network errors are raised, not reported as missing
+        bucket_name = self.get_bucket_name(bucket_name)
+        if use_cache:
+            metadata = self.metadata.get(bucket_name, key, default=False)
+            # writes cache what PutObject returns, which has no LastModified; those entries answer
+            # existence checks but are HEADed again here
+            if metadata is None or (metadata and metadata['LastModified'] is not None):
+                return metadata
         try:
-            self._s3.Object(bucket_name, key).load()
-            return True
-        except:
-            return False
+            response = self._s3_client.head_object(Bucket=bucket_name, Key=key)
+            metadata = {'Size': response['ContentLength'], 'ETag': response['ETag'],
+                        'LastModified': response['LastModified']}
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in NOT_FOUND_CODES:
+                raise
+            metadata = None
+        self.metadata.set(bucket_name, key, metadata)
+        return metadata
+
+    def file_exists(self, key: str, bucket_name: str = None, use_cache: bool = True) -> bool:
+        bucket_name = self.get_bucket_name(bucket_name)
+        if use_cache and (metadata := self.metadata.get(bucket_name, key, default=False)) is not False:
+            return metadata is not None
+        return self.head_object(key, bucket_name, use_cache=False) is not None
+
+    def exists_many(self, keys: Iterable[str], bucket_name: str = None, use_cache: bool = True) -> dict:
+        # {key: exists} for many keys. Cached answers are used first; the rest are found with
+        # one ListObjectsV2 scan over their common prefix when there are enough of them,
+        # otherwise (or if the scan turns out to cover far more objects) with concurrent HEADs.
+        bucket_name = self.get_bucket_name(bucket_name)
+        results = {}
+        remaining = []
+        for key in keys:
+            metadata = self.metadata.get(bucket_name, key, default=False) if use_cache else False
+            if metadata is False:
+                remaining.append(key)
+            else:
+                results[key] = metadata is not None
+        if len(remaining) >= EXISTS_LIST_MIN_KEYS:
+            remaining = self._exists_by_listing(remaining, bucket_name, results)
+        if remaining:
+            with ThreadPoolExecutor(max_workers=min(HEAD_CONCURRENCY, len(remaining))) as pool:
+                found = pool.map(lambda key: self.head_object(key, bucket_name, use_cache=False), remaining)
+                results.update((key, metadata is not None) for key, metadata in zip(remaining, found))
+        return results
+
+    def _exists_by_listing(self, keys, bucket_name, results) -> list:
+        # Scans the keys' common prefix from just before the smallest key to the largest one,
+        # giving up once it has listed more pages than concurrent HEADs would need rounds.
+        # Returns the keys it couldn't settle.
+        wanted = set(keys)
+        first, last = min(wanted), max(wanted)
+        max_pages = max(1, len(wanted) // HEAD_CONCURRENCY)
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        list_kwargs = {'StartAfter': first[:-1]} if first[:-1] else {}
+        pages = paginator.paginate(Bucket=bucket_name, Prefix=os.path.commonprefix([first, last]), **list_kwargs)
+        listed_up_to = None
+        for page_number, page in enumerate(pages, 1):
+            for item in page.get('Contents', []):
+                listed_up_to = item['Key']
+                if item['Key'] in wanted:
+                    self.metadata.set(bucket_name, item['Key'], {
+                        'Size': item['Size'], 'ETag': item['ETag'], 'LastModified': item['LastModified']})
+                    results[item['Key']] = True
+                    wanted.discard(item['Key'])
+            if not page.get('IsTruncated') or (listed_up_to is not None and listed_up_to >= last):
+                listed_up_to = last
+                break
+            if page_number >= max_pages:
+                break
+        settled = [key for key in wanted if listed_up_to is not None and key <= listed_up_to]
+        for key in settled:
+            self.metadata.set(bucket_name, key, None)
+            results[key] = False
+        return [key for key in wanted if key not in results]
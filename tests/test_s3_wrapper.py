@@ -0,0 +1,378 @@
+import asyncio
+import collections
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto is only needed for these tests
+    mock_aws = None
+
+from botocore.exceptions import ClientError
+
+from s3_wrapper import AsyncS3Utils, S3Utils, make_transfer_config, reset_connections
+
+BUCKET = 'enkrypt-tests'
+
+
+@unittest.skipIf(mock_aws is None, 'moto is not installed')
+class MotoTestCase(unittest.TestCase):
+    # every test gets an empty in-process S3 and fresh clients, so no request leaves the host
+
+    def setUp(self):
+        environ = {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                   'AWS_DEFAULT_REGION': 'us-east-1'}
+        patcher = mock.patch.dict(os.environ, environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ('S3_ENDPOINT_URL', 'S3_BUCKET_NAME', 'AWS_PROFILE_NAME', 'AWS_REGION'):
+            os.environ.pop(name, None)
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        reset_connections()
+        self.addCleanup(reset_connections)
+        self.s3 = S3Utils()
+        self.s3._s3_client.create_bucket(Bucket=BUCKET)
+        self.s3.set_default_bucket(BUCKET)
+
+    def put_objects(self, keys, body=b'x'):
+        for key in keys:
+            self.s3._s3_client.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    def listed_keys(self, prefix=''):
+        return sorted(self.s3.iter_keys(prefix))
+
+    def count_requests(self):
+        # a Counter of the S3 operations sent from here on, e.g. {'HeadObject': 3}
+        requests = collections.Counter()
+
+        def count(model=None, **kwargs):
+            requests[model.name] += 1
+        events = self.s3._s3_client.meta.events
+        events.register('before-call.s3', count, unique_id='tests-count-requests')
+        self.addCleanup(events.unregister, 'before-call.s3', unique_id='tests-count-requests')
+        return requests
+
+
+class MakeTransferConfigTest(unittest.TestCase):
+
+    def test_override_keeps_the_other_settings(self):
+        from boto3.s3.transfer import TransferConfig
+        base = TransferConfig(max_bandwidth=1000, multipart_chunksize=16 * 1024 * 1024, max_concurrency=5)
+        config = make_transfer_config(base, max_concurrency=2)
+        self.assertEqual((config.max_bandwidth, config.multipart_chunksize, config.max_concurrency),
+                         (1000, 16 * 1024 * 1024, 2))
+        self.assertEqual(base.max_concurrency, 5)
+
+    def test_unknown_setting_is_rejected(self):
+        self.assertRaises(TypeError, make_transfer_config, {'max_concurrency': 2}, bogus=1)
+        self.assertRaises(TypeError, make_transfer_config, make_transfer_config(max_concurrency=2), bogus=1)
+
+
+class InFlightCounter(object):
+    # wraps a function to record the most calls running at once
+
+    def __init__(self, func, delay=None):
+        self.func = func
+        self.delay = delay
+        self.running = 0
+        self.most = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, key, *args, **kwargs):
+        with self._lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        try:
+            if self.delay:
+                time.sleep(self.delay(key))
+            return self.func(key, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class AsyncS3UtilsTest(MotoTestCase):
+
+    def setUp(self):
+        super(AsyncS3UtilsTest, self).setUp()
+        self.async_s3 = AsyncS3Utils(self.s3, max_concurrency=8)
+        self.addCleanup(self.async_s3.close)
+        self.keys = ['async/%03d' % index for index in range(20)]
+
+    def test_single_calls(self):
+        async def run():
+            await self.async_s3.create_object('async/one', b'payload')
+            self.assertTrue(await self.async_s3.file_exists('async/one'))
+            self.assertEqual(await self.async_s3.get_object('async/one'), b'payload')
+            self.assertEqual(await self.async_s3.get_object_range('async/one', 1, 3), (b'ayl', 7))
+            await self.async_s3.delete_object('async/one')
+            self.assertFalse(await self.async_s3.file_exists('async/one', use_cache=False))
+        asyncio.run(run())
+
+    def test_put_many_and_get_many_keep_order(self):
+        contents = [('%s body' % key).encode() for key in self.keys]
+
+        def delay(key):
+            # the earliest keys finish last, so results only line up if they are put back in order
+            return 0.002 * (len(self.keys) - self.keys.index(key))
+        self.s3.get_object = InFlightCounter(self.s3.get_object, delay)
+        asyncio.run(self.async_s3.put_many(list(zip(self.keys, contents))))
+        bodies = asyncio.run(self.async_s3.get_many(self.keys))
+        self.assertEqual(bodies, contents)
+
+    def test_put_many_accepts_a_dict(self):
+        items = {key: key.encode() for key in self.keys[:3]}
+        asyncio.run(self.async_s3.put_many(items))
+        self.assertEqual(asyncio.run(self.async_s3.get_many(items)), list(items.values()))
+
+    def test_get_many_bounds_concurrency(self):
+        asyncio.run(self.async_s3.put_many((key, b'x') for key in self.keys))
+        get_object = self.s3.get_object
+        for concurrency in (1, 4):
+            with self.subTest(concurrency=concurrency):
+                counter = InFlightCounter(get_object, lambda key: 0.01)
+                self.s3.get_object = counter
+                asyncio.run(self.async_s3.get_many(self.keys, concurrency=concurrency))
+                self.assertLessEqual(counter.most, concurrency)
+                if concurrency > 1:
+                    self.assertGreater(counter.most, 1)
+
+    def test_put_many_bounds_concurrency(self):
+        counter = InFlightCounter(self.s3.create_object, lambda key: 0.01)
+        self.s3.create_object = counter
+        asyncio.run(self.async_s3.put_many(((key, b'x') for key in self.keys), concurrency=3))
+        self.assertLessEqual(counter.most, 3)
+        self.assertGreater(counter.most, 1)
+        self.assertEqual(asyncio.run(self.async_s3.get_many(self.keys)), [b'x'] * len(self.keys))
+
+    def test_get_many_return_exceptions(self):
+        asyncio.run(self.async_s3.create_object('async/there', b'here'))
+        results = asyncio.run(self.async_s3.get_many(['async/there', 'async/missing'], return_exceptions=True))
+        self.assertEqual(results[0], b'here')
+        self.assertIsInstance(results[1], Exception)
+
+
+class DeleteManyTest(MotoTestCase):
+
+    def setUp(self):
+        super(DeleteManyTest, self).setUp()
+        self.keys = ['delete/%03d' % index for index in range(25)]
+        self.put_objects(self.keys)
+        # small batches, so a few dozen keys exercise the batching
+        patcher = mock.patch('s3_wrapper.utils.DELETE_BATCH_SIZE', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deletes_every_key_in_batches(self):
+        delete_objects = self.s3._s3_client.delete_objects
+        with mock.patch.object(self.s3._s3_client, 'delete_objects', wraps=delete_objects) as wrapped:
+            errors = self.s3.delete_many(key for key in self.keys)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(len(call.kwargs['Delete']['Objects']) for call in wrapped.call_args_list),
+                         [5, 10, 10])
+        self.assertEqual(self.listed_keys(), [])
+        self.assertFalse(self.s3.file_exists(self.keys[0]))
+
+    def test_failed_batch_is_reported_per_key(self):
+        delete_objects = self.s3._s3_client.delete_objects
+
+        def fail_first_batch(**kwargs):
+            if kwargs['Delete']['Objects'][0]['Key'] == self.keys[0]:
+                raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Reduce your request rate'}},
+                                  'DeleteObjects')
+            return delete_objects(**kwargs)
+        with mock.patch.object(self.s3._s3_client, 'delete_objects', side_effect=fail_first_batch):
+            errors = self.s3.delete_many(self.keys, batches_in_flight=2)
+        self.assertEqual([error['Key'] for error in errors], self.keys[:10])
+        self.assertEqual({error['Code'] for error in errors}, {'SlowDown'})
+        self.assertEqual(self.listed_keys(), self.keys[:10])
+
+    def test_key_errors_are_reported(self):
+        delete_objects = self.s3._s3_client.delete_objects
+
+        def deny_one(**kwargs):
+            response = delete_objects(**kwargs)
+            if any(item['Key'] == self.keys[3] for item in kwargs['Delete']['Objects']):
+                response['Errors'] = [{'Key': self.keys[3], 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+            return response
+        self.assertTrue(self.s3.file_exists(self.keys[3]))
+        with mock.patch.object(self.s3._s3_client, 'delete_objects', side_effect=deny_one):
+            errors = self.s3.delete_many(self.keys)
+        self.assertEqual(errors, [{'Key': self.keys[3], 'Code': 'AccessDenied', 'Message': 'Access Denied'}])
+        # deleted keys are cached as missing; the cached answer of the key that failed is dropped
+        self.assertIsNone(self.s3.metadata.get(BUCKET, self.keys[4], default=False))
+        self.assertIs(self.s3.metadata.get(BUCKET, self.keys[3], default=False), False)
+
+    def test_delete_prefix_keeps_other_prefixes(self):
+        self.put_objects(['keep/1', 'keep/2'])
+        self.assertEqual(self.s3.delete_prefix('delete/'), [])
+        self.assertEqual(self.listed_keys(), ['keep/1', 'keep/2'])
+
+    def test_async_delete_many(self):
+        async_s3 = AsyncS3Utils(self.s3)
+        self.addCleanup(async_s3.close)
+        self.assertEqual(asyncio.run(async_s3.delete_many(self.keys)), [])
+        self.assertEqual(self.listed_keys(), [])
+
+
+class ExistsManyTest(MotoTestCase):
+
+    def setUp(self):
+        super(ExistsManyTest, self).setUp()
+        self.present = ['exists/%03d' % index for index in range(0, 60, 2)]
+        self.missing = ['exists/%03d' % index for index in range(1, 60, 2)]
+        self.put_objects(self.present)
+
+    def expected(self, keys):
+        return {key: key in self.present for key in keys}
+
+    def test_few_keys_are_headed(self):
+        keys = self.present[:3] + self.missing[:3]
+        requests = self.count_requests()
+        self.assertEqual(self.s3.exists_many(keys), self.expected(keys))
+        self.assertEqual(requests, {'HeadObject': len(keys)})
+
+    def test_many_keys_are_listed(self):
+        keys = self.present + self.missing
+        requests = self.count_requests()
+        self.assertEqual(self.s3.exists_many(keys), self.expected(keys))
+        self.assertEqual(requests, {'ListObjectsV2': 1})
+
+    def test_answers_are_cached(self):
+        keys = self.present + self.missing
+        self.s3.exists_many(keys)
+        requests = self.count_requests()
+        self.assertEqual(self.s3.exists_many(keys), self.expected(keys))
+        self.assertEqual(self.s3.file_exists(self.missing[0]), False)
+        self.assertEqual(sum(requests.values()), 0)
+
+    def test_use_cache_false_asks_s3(self):
+        key = self.present[0]
+        self.s3.exists_many([key])
+        self.s3._s3_client.delete_object(Bucket=BUCKET, Key=key)  # behind the cache's back
+        self.assertEqual(self.s3.exists_many([key]), {key: True})
+        self.assertEqual(self.s3.exists_many([key], use_cache=False), {key: False})
+
+    def test_keys_under_different_prefixes(self):
+        self.put_objects(['other/1'])
+        keys = self.present + self.missing + ['other/1', 'other/2', 'zzz']
+        self.assertEqual(self.s3.exists_many(keys), dict(self.expected(keys), **{'other/1': True}))
+
+    def test_writes_never_cache_a_missing_last_modified(self):
+        self.s3.create_object('written', b'data')
+        self.s3.upload_stream('streamed', [b'data'])
+        self.s3.copy_object('copied', self.present[0])
+        self.s3.copy_object('copied-big', 'written', multipart_threshold=1)
+        requests = self.count_requests()
+        self.assertTrue(self.s3.file_exists('written'))
+        self.assertEqual(sum(requests.values()), 0)
+        for key in ('written', 'streamed', 'copied', 'copied-big'):
+            with self.subTest(key=key):
+                self.assertIsNotNone(self.s3.head_object(key)['LastModified'])
+        self.assertEqual(requests, {'HeadObject': 3})
+        self.assertIsNotNone(self.s3.head_object('written')['LastModified'])
+        self.assertEqual(requests, {'HeadObject': 3})
+
+    def test_async_exists_many(self):
+        async_s3 = AsyncS3Utils(self.s3)
+        self.addCleanup(async_s3.close)
+        keys = self.present[:5] + self.missing[:5]
+        self.assertEqual(asyncio.run(async_s3.exists_many(iter(keys))), self.expected(keys))
+
+
+class MoveManyTest(MotoTestCase):
+
+    def setUp(self):
+        super(MoveManyTest, self).setUp()
+        self.sources = ['move/%02d' % index for index in range(10)]
+        for key in self.sources:
+            self.put_objects([key], body=key.encode())
+        self.pairs = [(key, key.replace('move/', 'moved/')) for key in self.sources]
+        patcher = mock.patch('s3_wrapper.utils.DELETE_BATCH_SIZE', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertMoved(self, pairs):
+        for source_key, new_key in pairs:
+            self.assertEqual(self.s3.get_object(new_key), source_key.encode())
+            self.assertFalse(self.s3.file_exists(source_key, use_cache=False))
+
+    def test_moves_every_pair(self):
+        self.assertEqual(self.s3.move_many(self.pairs, concurrency=3), [])
+        self.assertMoved(self.pairs)
+        self.assertEqual(self.listed_keys('move/'), [])
+
+    def test_accepts_a_dict(self):
+        self.assertEqual(self.s3.move_many(dict(self.pairs[:2])), [])
+        self.assertMoved(self.pairs[:2])
+
+    def test_failed_copy_keeps_its_source(self):
+        pairs = self.pairs[:3] + [('move/missing', 'moved/missing')]
+        errors = self.s3.move_many(pairs)
+        self.assertEqual([(error['Key'], error['NewKey']) for error in errors], [('move/missing', 'moved/missing')])
+        self.assertMoved(self.pairs[:3])
+        self.assertEqual(self.listed_keys('move/'), self.sources[3:])
+
+    def test_incomplete_copy_keeps_its_source(self):
+        head_object = self.s3.head_object
+
+        def short_copy(key, *args, **kwargs):
+            metadata = head_object(key, *args, **kwargs)
+            if key == self.pairs[1][1]:
+                metadata = dict(metadata, Size=metadata['Size'] - 1)
+            return metadata
+        self.s3.head_object = short_copy
+        errors = self.s3.move_many(self.pairs[:3])
+        self.assertEqual([(error['Key'], error['Code']) for error in errors], [(self.sources[1], 'IncompleteCopy')])
+        self.assertTrue(self.s3.file_exists(self.sources[1], use_cache=False))
+        self.assertMoved([self.pairs[0], self.pairs[2]])
+
+    def test_delete_failure_is_reported(self):
+        refused = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'DeleteObjects')
+        with mock.patch.object(self.s3._s3_client, 'delete_objects', side_effect=refused):
+            errors = self.s3.move_many(self.pairs)
+        self.assertEqual(sorted(error['Key'] for error in errors), self.sources)
+        self.assertEqual(self.listed_keys('move/'), self.sources)
+        self.assertEqual(len(self.listed_keys('moved/')), len(self.pairs))
+
+    def test_move_object(self):
+        source_key, new_key = self.pairs[0]
+        self.assertTrue(self.s3.move_object(source_key, new_key))
+        self.assertMoved([self.pairs[0]])
+
+    def test_async_move_many(self):
+        async_s3 = AsyncS3Utils(self.s3)
+        self.addCleanup(async_s3.close)
+        self.assertEqual(asyncio.run(async_s3.move_many(self.pairs)), [])
+        self.assertMoved(self.pairs)
+
+    def test_multipart_copy_keeps_headers(self):
+        headers = {'Metadata': {'owner': 'tests'}, 'ContentType': 'text/plain', 'ContentEncoding': 'gzip',
+                   'ContentDisposition': 'attachment', 'ContentLanguage': 'en', 'CacheControl': 'max-age=60',
+                   'StorageClass': 'STANDARD_IA', 'ServerSideEncryption': 'AES256'}
+        body = os.urandom(6 * 1024 * 1024)
+        self.s3._s3_client.put_object(Bucket=BUCKET, Key='big', Body=body, Tagging='team=crypto&tier=a b',
+                                      **headers)
+        requests = self.count_requests()
+        self.s3.copy_object('big-copy', 'big', multipart_threshold=1, part_size=5 * 1024 * 1024)
+        self.assertEqual(requests['UploadPartCopy'], 2)
+        copy = self.s3._s3_client.head_object(Bucket=BUCKET, Key='big-copy')
+        self.assertEqual({name: copy.get(name) for name in headers}, headers)
+        self.assertEqual(self.s3.get_object('big-copy'), body)
+        tags = self.s3._s3_client.get_object_tagging(Bucket=BUCKET, Key='big-copy')['TagSet']
+        self.assertEqual(sorted((tag['Key'], tag['Value']) for tag in tags), [('team', 'crypto'), ('tier', 'a b')])
+
+    def test_copy_keeps_storage_class(self):
+        self.s3._s3_client.put_object(Bucket=BUCKET, Key='cold', Body=b'x', StorageClass='STANDARD_IA')
+        self.s3.copy_object('cold-copy', 'cold')
+        self.assertEqual(self.s3._s3_client.head_object(Bucket=BUCKET, Key='cold-copy').get('StorageClass'),
+                         'STANDARD_IA')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,313 @@
+import io
+import os
+import unittest
+
+from Enkrypt import Dcryptor, Encryptor, SegmentHeader, SegmentedEncryptor, decrypt_bytes, encrypt_bytes
+
+SEGMENT_SIZE = 1024
+
+
+# a cheap scrypt cost, so each test derives its keys in milliseconds
+class FastEncryptor(Encryptor):
+    KDF_N = 2 ** 10
+
+
+class FastSegmentedEncryptor(SegmentedEncryptor):
+    KDF_N = 2 ** 10
+
+
+class FastDcryptor(Dcryptor):
+    KDF_N = 2 ** 10
+
+
+def encrypt(data, **kwargs):
+    kwargs.setdefault('segment_size', SEGMENT_SIZE)
+    return bytes(FastSegmentedEncryptor(input_string=data, workers=1, **kwargs).do_encryption())
+
+
+def read_header(encrypted):
+    return SegmentHeader.read(io.BytesIO(encrypted))
+
+
+def unknown_length(data):
+    # a stream without getbuffer, which Dcryptor has to decrypt with iter_decryption
+    return io.BufferedReader(io.BytesIO(data))
+
+
+class DecryptPathsMixin(object):
+    # every way a file is read back: known size, streamed, one-shot and verify-only
+
+    def decrypt_all(self, encrypted):
+        return {
+            'do_decryption': bytes(FastDcryptor(input_string=encrypted, workers=1).do_decryption()),
+            'iter_decryption': b''.join(FastDcryptor(input_stream=unknown_length(encrypted)).iter_decryption()),
+            'decrypt_bytes': bytes(decrypt_bytes(encrypted, dcryptor_class=FastDcryptor)),
+        }
+
+    def assertRoundTrips(self, encrypted, data, verified=None):
+        for path, plaintext in self.decrypt_all(encrypted).items():
+            with self.subTest(path=path):
+                self.assertEqual(plaintext, data)
+        with self.subTest(path='do_verification'):
+            authenticated = FastDcryptor(input_stream=unknown_length(encrypted)).do_verification()
+            self.assertEqual(authenticated, len(data) if verified is None else verified)
+
+    def assertRejected(self, encrypted):
+        readers = {
+            'do_decryption': lambda: FastDcryptor(input_string=encrypted, workers=1).do_decryption(),
+            'iter_decryption': lambda: b''.join(
+                FastDcryptor(input_stream=unknown_length(encrypted)).iter_decryption()),
+            'decrypt_bytes': lambda: decrypt_bytes(encrypted, dcryptor_class=FastDcryptor),
+            'do_verification': lambda: FastDcryptor(input_stream=unknown_length(encrypted)).do_verification(),
+        }
+        for path, read in readers.items():
+            with self.subTest(path=path):
+                self.assertRaises(ValueError, read)
+
+
+class SegmentedFormatTest(DecryptPathsMixin, unittest.TestCase):
+
+    def test_round_trip(self):
+        for size in (0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, 3 * SEGMENT_SIZE, 3 * SEGMENT_SIZE + 1):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                self.assertRoundTrips(encrypt(data), data)
+
+    def test_layout(self):
+        data = os.urandom(3 * SEGMENT_SIZE + 1)
+        encrypted = encrypt(data)
+        header = read_header(encrypted)
+        self.assertEqual(header.version, SegmentHeader.ENVELOPE_VERSION)
+        self.assertEqual(header.segment_size, SEGMENT_SIZE)
+        self.assertEqual(len(encrypted), header.size + len(data) + 4 * SegmentHeader.TAG_LENGTH)
+
+    def test_files_never_share_a_segment_key(self):
+        # a 7-byte nonce prefix alone can't keep (key, nonce) pairs unique across many files
+        for envelope in (True, False):
+            with self.subTest(envelope=envelope):
+                first, second = read_header(encrypt(b'same', envelope=envelope)), \
+                    read_header(encrypt(b'same', envelope=envelope))
+                self.assertNotEqual(FastDcryptor.get_segment_key(first), FastDcryptor.get_segment_key(second))
+
+    def test_without_envelope_each_file_gets_a_fresh_salt(self):
+        data = os.urandom(SEGMENT_SIZE + 1)
+        encrypted = encrypt(data, envelope=False)
+        self.assertEqual(read_header(encrypted).version, SegmentHeader.VERSION)
+        self.assertNotEqual(read_header(encrypted).salt, Encryptor.get_process_salt())
+        self.assertRoundTrips(encrypted, data)
+
+    def test_empty_file_is_one_final_segment(self):
+        encrypted = encrypt(b'')
+        self.assertEqual(len(encrypted), read_header(encrypted).size + SegmentHeader.TAG_LENGTH)
+
+    def test_parallel_workers_match(self):
+        data = os.urandom(8 * SEGMENT_SIZE + 5)
+        encrypted = bytes(FastSegmentedEncryptor(input_string=data, segment_size=SEGMENT_SIZE, workers=4)
+                          .do_encryption())
+        self.assertEqual(bytes(FastDcryptor(input_string=encrypted, workers=4).do_decryption()), data)
+
+    def test_tampered_segment_is_rejected(self):
+        encrypted = bytearray(encrypt(os.urandom(3 * SEGMENT_SIZE)))
+        encrypted[read_header(encrypted).size + SEGMENT_SIZE + 100] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_tampered_tag_is_rejected(self):
+        encrypted = bytearray(encrypt(os.urandom(SEGMENT_SIZE + 1)))
+        encrypted[-1] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_tampered_header_is_rejected(self):
+        # the header is the associated data of every segment
+        encrypted = bytearray(encrypt(os.urandom(2 * SEGMENT_SIZE)))
+        encrypted[read_header(encrypted).size - 1] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_reordered_segments_are_rejected(self):
+        encrypted = encrypt(os.urandom(3 * SEGMENT_SIZE))
+        start = read_header(encrypted).size
+        sealed = SEGMENT_SIZE + SegmentHeader.TAG_LENGTH
+        first, second = encrypted[start:start + sealed], encrypted[start + sealed:start + 2 * sealed]
+        self.assertRejected(encrypted[:start] + second + first + encrypted[start + 2 * sealed:])
+
+    def test_dropped_final_segment_is_rejected(self):
+        # cut after a full segment, so the file still ends on a segment boundary
+        data = os.urandom(3 * SEGMENT_SIZE + 1)
+        encrypted = encrypt(data)
+        self.assertRejected(encrypted[:-(1 + SegmentHeader.TAG_LENGTH)])
+
+    def test_dropped_final_full_segment_is_rejected(self):
+        encrypted = encrypt(os.urandom(3 * SEGMENT_SIZE))
+        truncated = encrypted[:-(SEGMENT_SIZE + SegmentHeader.TAG_LENGTH)]
+        self.assertRejected(truncated)
+        with self.assertRaisesRegex(ValueError, 'Truncated'):
+            FastDcryptor(input_stream=unknown_length(truncated)).do_verification()
+
+    def test_truncated_segment_is_rejected(self):
+        encrypted = encrypt(os.urandom(2 * SEGMENT_SIZE))
+        self.assertRejected(encrypted[:-10])
+
+    def test_truncated_header_is_rejected(self):
+        encrypted = encrypt(os.urandom(10))
+        self.assertRejected(encrypted[:read_header(encrypted).size - 1])
+
+    def test_unknown_version_is_rejected(self):
+        encrypted = bytearray(encrypt(os.urandom(10)))
+        encrypted[len(SegmentHeader.MAGIC)] = 99
+        self.assertRejected(bytes(encrypted))
+
+
+class LegacyFormatTest(DecryptPathsMixin, unittest.TestCase):
+    # the single-stream format of Encryptor and encrypt_bytes: salt | nonce | ciphertext | tag
+
+    def test_round_trip(self):
+        for size in (0, 1, SEGMENT_SIZE, 3 * SEGMENT_SIZE + 1):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                self.assertRoundTrips(bytes(FastEncryptor(input_string=data).do_encryption()), data)
+                self.assertRoundTrips(bytes(encrypt_bytes(data, encryptor_class=FastEncryptor)), data)
+
+    def test_streamed_encryption_matches(self):
+        data = os.urandom(3 * SEGMENT_SIZE)
+        encrypted = b''.join(FastEncryptor(input_string=data).iter_encryption())
+        self.assertRoundTrips(encrypted, data)
+
+    def test_tampered_ciphertext_is_rejected(self):
+        encrypted = bytearray(FastEncryptor(input_string=os.urandom(100)).do_encryption())
+        encrypted[Encryptor.SALT_LENGTH + Encryptor.NONCE_LENGTH + 50] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_truncated_tag_is_rejected(self):
+        encrypted = bytes(FastEncryptor(input_string=os.urandom(100)).do_encryption())
+        self.assertRejected(encrypted[:-1])
+
+
+class CompressedFormatTest(DecryptPathsMixin, unittest.TestCase):
+    # version 2 header: compressed, then cut into AES-GCM segments
+
+    def encrypt(self, data, **kwargs):
+        return encrypt(data, envelope=False, **kwargs)
+
+    def compressible(self, size):
+        return (b'enkrypt segmented format ' * (size // 25 + 1))[:size]
+
+    def test_round_trip(self):
+        for codec in ('zlib', 'bz2', 'lzma'):
+            for size in (SEGMENT_SIZE, 3 * SEGMENT_SIZE + 1, 200 * SEGMENT_SIZE + 1):
+                with self.subTest(codec=codec, size=size):
+                    data = self.compressible(size)
+                    encrypted = self.encrypt(data, compression=codec)
+                    header = read_header(encrypted)
+                    self.assertEqual(header.version, SegmentHeader.COMPRESSED_VERSION)
+                    self.assertEqual(header.codec.name, codec)
+                    # verification covers the compressed bytes, so it reports fewer than the plaintext
+                    verified = FastDcryptor(input_stream=unknown_length(encrypted)).do_verification()
+                    self.assertRoundTrips(encrypted, data, verified)
+                    if size > SEGMENT_SIZE:
+                        self.assertLess(len(encrypted), size)
+
+    def test_incompressible_input_is_stored_as_is(self):
+        data = os.urandom(4 * SEGMENT_SIZE)
+        encrypted = self.encrypt(data, compression='zlib')
+        self.assertEqual(read_header(encrypted).version, SegmentHeader.VERSION)
+        self.assertRoundTrips(encrypted, data)
+
+    def test_tampered_segment_is_rejected(self):
+        encrypted = bytearray(self.encrypt(self.compressible(200 * SEGMENT_SIZE), compression='zlib'))
+        encrypted[read_header(encrypted).size + 10] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_unknown_codec_is_rejected(self):
+        encrypted = bytearray(self.encrypt(self.compressible(SEGMENT_SIZE), compression='zlib'))
+        encrypted[read_header(encrypted).size - 1] = 99
+        self.assertRejected(bytes(encrypted))
+
+
+class CipherFormatTest(DecryptPathsMixin, unittest.TestCase):
+    # version 3 header: segments sealed with ChaCha20-Poly1305 instead of AES-GCM
+
+    def encrypt(self, data, **kwargs):
+        return encrypt(data, envelope=False, **kwargs)
+
+    def test_round_trip(self):
+        for size in (0, 1, SEGMENT_SIZE, 3 * SEGMENT_SIZE + 1):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                encrypted = self.encrypt(data, cipher='chacha20-poly1305')
+                header = read_header(encrypted)
+                self.assertEqual(header.version, SegmentHeader.CIPHER_VERSION)
+                self.assertEqual(header.aead.name, 'chacha20-poly1305')
+                self.assertIsNone(header.codec)
+                self.assertRoundTrips(encrypted, data)
+
+    def test_compressed_round_trip(self):
+        data = b'chacha ' * (10 * SEGMENT_SIZE)
+        encrypted = self.encrypt(data, cipher='chacha20-poly1305', compression='zlib')
+        header = read_header(encrypted)
+        self.assertEqual(header.version, SegmentHeader.CIPHER_VERSION)
+        self.assertEqual(header.codec.name, 'zlib')
+        self.assertRoundTrips(encrypted, data, FastDcryptor(input_stream=unknown_length(encrypted)).do_verification())
+
+    def test_aes_gcm_keeps_the_old_header(self):
+        self.assertEqual(read_header(self.encrypt(b'x', cipher='aes-gcm')).version, SegmentHeader.VERSION)
+
+    def test_tampered_segment_is_rejected(self):
+        encrypted = bytearray(self.encrypt(os.urandom(3 * SEGMENT_SIZE), cipher='chacha20-poly1305'))
+        encrypted[read_header(encrypted).size + 5] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_dropped_final_segment_is_rejected(self):
+        encrypted = self.encrypt(os.urandom(3 * SEGMENT_SIZE), cipher='chacha20-poly1305')
+        self.assertRejected(encrypted[:-(SEGMENT_SIZE + SegmentHeader.TAG_LENGTH)])
+
+    def test_unknown_cipher_is_rejected(self):
+        encrypted = bytearray(self.encrypt(os.urandom(10), cipher='chacha20-poly1305'))
+        encrypted[read_header(encrypted).size - 2] = 99
+        self.assertRejected(bytes(encrypted))
+
+
+class EnvelopeFormatTest(DecryptPathsMixin, unittest.TestCase):
+    # version 4 header: a random data key per file, wrapped under the password-derived master key
+
+    def test_round_trip(self):
+        for size in (0, 1, SEGMENT_SIZE, 3 * SEGMENT_SIZE + 1):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                encrypted = encrypt(data, envelope=True)
+                header = read_header(encrypted)
+                self.assertEqual(header.version, SegmentHeader.ENVELOPE_VERSION)
+                self.assertEqual(len(header.wrapped_key), SegmentHeader.WRAPPED_KEY_LENGTH)
+                self.assertRoundTrips(encrypted, data)
+
+    def test_cipher_and_compression_round_trip(self):
+        data = b'envelope ' * (10 * SEGMENT_SIZE)
+        encrypted = encrypt(data, envelope=True, cipher='chacha20-poly1305', compression='zlib')
+        header = read_header(encrypted)
+        self.assertEqual(header.version, SegmentHeader.ENVELOPE_VERSION)
+        self.assertEqual((header.aead.name, header.codec.name), ('chacha20-poly1305', 'zlib'))
+        self.assertRoundTrips(encrypted, data, FastDcryptor(input_stream=unknown_length(encrypted)).do_verification())
+
+    def test_each_file_gets_its_own_data_key(self):
+        first, second = encrypt(b'same', envelope=True), encrypt(b'same', envelope=True)
+        self.assertEqual(read_header(first).salt, read_header(second).salt)
+        self.assertNotEqual(read_header(first).wrapped_key, read_header(second).wrapped_key)
+        self.assertNotEqual(FastDcryptor.get_segment_key(read_header(first)),
+                            FastDcryptor.get_segment_key(read_header(second)))
+
+    def test_tampered_wrapped_key_is_rejected(self):
+        encrypted = bytearray(encrypt(os.urandom(SEGMENT_SIZE), envelope=True))
+        encrypted[read_header(encrypted).size - 1] ^= 1
+        self.assertRejected(bytes(encrypted))
+
+    def test_wrong_password_is_rejected(self):
+        class OtherPasswordDcryptor(FastDcryptor):
+            password = 'other password'
+        encrypted = encrypt(os.urandom(SEGMENT_SIZE), envelope=True)
+        self.assertRaises(ValueError, decrypt_bytes, encrypted, OtherPasswordDcryptor)
+
+    def test_dropped_final_segment_is_rejected(self):
+        encrypted = encrypt(os.urandom(3 * SEGMENT_SIZE), envelope=True)
+        self.assertRejected(encrypted[:-(SEGMENT_SIZE + SegmentHeader.TAG_LENGTH)])
+
+
+if __name__ == '__main__':
+    unittest.main()
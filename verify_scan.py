@@ -0,0 +1,115 @@
+"""
+Verifies every encrypted object under an S3 prefix without keeping any plaintext.
+
+Each object is streamed from S3 through tag authentication only (Dcryptor.do_verification),
+so memory stays at a few chunks per worker and nothing touches the disk. Objects are checked
+concurrently; the report lists corrupt (failed authentication), truncated and undecryptable
+(unknown format, cipher or codec) keys, plus the throughput reached. Exits 1 if any key failed.
+
+    python verify_scan.py nightly/ --bucket zappa-encode
+    python verify_scan.py nightly/ --workers 64 --processes 4
+"""
+import argparse
+import json
+import sys
+import time
+from itertools import tee
+
+from botocore.exceptions import BotoCoreError, ClientError
+from urllib3.exceptions import HTTPError
+
+from Enkrypt import Dcryptor, run_segment_jobs
+from s3_wrapper import S3Utils, reset_connections
+
+SCAN_WORKERS = 32  # objects verified at once; keep below the connection pool size
+# S3 refusing a request, or the connection failing mid-stream (timeouts, resets, truncated
+# responses); botocore doesn't wrap every urllib3 error raised while reading a body
+TRANSPORT_ERRORS = (ClientError, BotoCoreError, HTTPError, OSError)
+
+
+def classify(error):
+    if isinstance(error, TRANSPORT_ERRORS):
+        return 'errors'
+    message = str(error)
+    if 'Truncated' in message:
+        return 'truncated'
+    if 'MAC check failed' in message:
+        return 'corrupt'
+    return 'undecryptable'
+
+
+def verify_object(key, bucket_name=None, dcryptor_class=None):
+    # returns (status, bytes authenticated, error message); status is 'ok' or a classify() bucket
+    dcryptor_class = dcryptor_class or Dcryptor
+    try:
+        body = S3Utils().get_object_stream(key, bucket_name=bucket_name)
+        return 'ok', dcryptor_class(input_stream=body, workers=1).do_verification(), None
+    except (ValueError, KeyError) + TRANSPORT_ERRORS as e:
+        return classify(e), 0, '%s: %s' % (type(e).__name__, e)
+
+
+def verify_keys(keys, bucket_name=None, workers=SCAN_WORKERS):
+    # runs in a worker process when scanning with --processes; returns one result per key
+    jobs = ((verify_object, key, bucket_name) for key in keys)
+    return list(run_segment_jobs(jobs, workers))
+
+
+def iter_key_batches(s3, prefix, bucket_name, size):
+    batch = []
+    for summary in s3.find_files_with_prefix(prefix, bucket_name):
+        batch.append((summary.key, summary.size))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scan_prefix(prefix, bucket_name=None, workers=SCAN_WORKERS, processes=1, s3=None, on_failure=None):
+    # Verifies every object under prefix; workers threads per process stream objects
+    # concurrently, and with processes > 1 each process takes a listing batch.
+    s3 = s3 or S3Utils()
+    report = {'objects': 0, 'ok': 0, 'bytes': 0, 'corrupt': [], 'truncated': [], 'undecryptable': [], 'errors': []}
+    start = time.perf_counter()
+    batches = iter_key_batches(s3, prefix, bucket_name, workers * 4)
+    if processes > 1:
+        reset_connections()  # clients must not be inherited by forked workers
+        batches, job_batches = tee(batches)
+        jobs = ((verify_keys, [key for key, _ in batch], bucket_name, workers) for batch in job_batches)
+        results = zip(batches, run_segment_jobs(jobs, processes, use_processes=True))
+    else:
+        results = ((batch, verify_keys([key for key, _ in batch], bucket_name, workers)) for batch in batches)
+    for batch, batch_results in results:
+        for (key, size), (status, _, error) in zip(batch, batch_results):
+            report['objects'] += 1
+            report['bytes'] += size
+            if status == 'ok':
+                report['ok'] += 1
+                continue
+            report[status].append({'key': key, 'error': error})
+            if on_failure:
+                on_failure(key, status, error)
+    seconds = time.perf_counter() - start
+    report['seconds'] = round(seconds, 3)
+    report['objects_per_s'] = round(report['objects'] / seconds, 1) if seconds else None
+    report['mb_per_s'] = round(report['bytes'] / seconds / 1024 / 1024, 2) if seconds else None
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('prefix', help='S3 key prefix to verify, e.g. nightly/')
+    parser.add_argument('--bucket', help='bucket name (defaults to S3_BUCKET_NAME)')
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS, help='objects verified at once per process')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes, for hosts with spare cores')
+    args = parser.parse_args(argv)
+    report = scan_prefix(args.prefix, args.bucket, args.workers, args.processes,
+                         on_failure=lambda key, status, error: print('%s\t%s\t%s' % (status, key, error),
+                                                                     file=sys.stderr))
+    print(json.dumps(report))
+    failed = len(report['corrupt']) + len(report['truncated']) + len(report['undecryptable']) + len(report['errors'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())